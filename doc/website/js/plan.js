@@ -104,11 +104,34 @@
             return true;
         }
         
-        for (i = 0; i < segments.length; i++) {
-            segment = segments[i];
-            item_id = '#' + segment.id;
-            id = item_id.slice(0, item_id.lastIndexOf('-tag'));
-            $(item_id).children().each(extract_metadata);
+        // use the index precomputed by pyutil.rst if it's available and only
+        // fallback to scraping the tag segments otherwise
+        if (window.PLAN_INDEX) {
+            $.each(window.PLAN_INDEX.items, function (m, plan_item) {
+                id = '#' + plan_item.id;
+                if (plan_item.deps.length) {
+                    ITEM2DEPS[id] = plan_item.deps[plan_item.deps.length - 1];
+                }
+                if (plan_item.tags.length) {
+                    IDS2TAGS[id] = plan_item.tags.slice(0);
+                }
+                $.each(plan_item.tags, function (n, k) {
+                    var v = window.PLAN_INDEX.tags[k];
+                    if (!(k in TAG2NAME)) {
+                        TAG2NAME[k] = v.name;
+                        NAME2TAG[v.name] = k;
+                        TAG2NORM[k] = v.norm;
+                        NORM2TAG[v.norm] = k;
+                    }
+                });
+            });
+        } else {
+            for (i = 0; i < segments.length; i++) {
+                segment = segments[i];
+                item_id = '#' + segment.id;
+                id = item_id.slice(0, item_id.lastIndexOf('-tag'));
+                $(item_id).children().each(extract_metadata);
+            }
         }
 
         $.each(IDS2TAGS, function (k, v) {
@@ -41,15 +41,136 @@ The method returns ``None`` for non-Teredo addresses:
   >>> ip = IPv6('::1')
   >>> ip.get_teredo_ipv4_address()
 
+More generally, the ``classify`` method identifies special-purpose addresses,
+including the various IPv4 transition/tunnelling mechanisms, using a table of
+precompiled prefix masks:
+
+  >>> IPv6('2001::53aa:64c:0:3ffe:a3e2:b3d8').classify()
+  'teredo'
+
+  >>> IPv6('2002:c000:204::1').classify()
+  '6to4'
+
+  >>> IPv6('64:ff9b::c000:204').classify()
+  'nat64'
+
+  >>> IPv6('::ffff:192.0.2.4').classify()
+  'ipv4-mapped'
+
+And ``None`` is returned for ordinary global unicast addresses:
+
+  >>> IPv6('2a00:1450:4009:80b::200e').classify()
+
+The IPv4 address carried by any of these mechanisms can be extracted with:
+
+  >>> IPv6('2002:c000:204::1').get_embedded_ipv4_address()
+  192.0.2.4
+
+  >>> IPv6('64:ff9b:1:c000:2:400::').get_embedded_ipv4_address()
+  192.0.2.4
+
+For log analysis, ``classify_ipv6_many`` takes a sequence of IPv6 strings and
+integer values and returns the matching classifications:
+
+  >>> classify_ipv6_many(['fe80::1', 'fd00::1', '2001:db8::1', '::1'])
+  ['link-local', 'ula', 'documentation', 'loopback']
+
+  >>> classify_ipv6_many([1L, 'fe80::1', IPv6('2002:c000:204::1')])
+  ['loopback', 'link-local', '6to4']
+
+Large allow/deny lists can be held in an ``IPRangeIndex``, which merges
+overlapping networks and stores the range boundaries in compact sorted arrays:
+
+  >>> index = IPRangeIndex()
+  >>> index.add('10.0.0.0/8')
+  >>> index.add('10.20.0.0/16')
+  >>> index.add('192.168.1.1-192.168.1.9')
+  >>> index.add('192.168.1.10')
+  >>> len(index)
+  2
+
+  >>> list(index)
+  [(10.0.0.0, 10.255.255.255), (192.168.1.1, 192.168.1.10)]
+
+Membership tests are binary searches over the arrays:
+
+  >>> '10.1.2.3' in index
+  True
+
+  >>> IPv4('192.168.1.11') in index
+  False
+
+Individual addresses can be held in an ``IPSet`` instead. Both types take a
+``version`` parameter and IPv6 values are stored as 128-bit array entries:
+
+  >>> ips = IPSet(['2001:db8::2', '::1', '2001:db8::2'], version=6)
+  >>> list(ips)
+  [::1, 2001:db8::2]
+
+  >>> '2001:db8::2' in ips
+  True
+
+  >>> '2001:db8::3' in ips
+  False
+
+Both types can also be bulk loaded from text files with one entry per line and
+optional ``#`` comments using the ``load`` method.
+
+When dealing with lots of addresses, e.g. a column from a log file, the batch
+functions avoid creating individual objects and return plain integers:
+
+  >>> parse_ipv4_many(['123.45.67.89', '10.0.0.1'])
+  [2066563929L, 167772161L]
+
+  >>> format_ipv4_many([2066563929, 167772161])
+  ['123.45.67.89', '10.0.0.1']
+
+  >>> parse_ipv6_many(['::1', '2001:db8::2'])
+  [1L, 42540766411282592856903984951653826562L]
+
+  >>> format_ipv6_many([1, 42540766411282592856903984951653826562L])
+  ['::1', '2001:db8::2']
+
+Invalid values raise an ``InvalidIPAddress`` error unless a ``default`` value is
+given to use in their place:
+
+  >>> parse_ipv4_many(['10.0.0.1', 'invalid'], default=None)
+  [167772161L, None]
+
+The IP classes don't have a per-instance ``__dict__``, so they take up no more
+memory than a plain ``long``. And, for values which are seen repeatedly, e.g.
+client IPs, the ``intern_ipv4`` and ``intern_ipv6`` functions return shared
+instances from a bounded cache:
+
+  >>> intern_ipv4('123.45.67.89') is intern_ipv4('123.45.67.89')
+  True
+
+  >>> intern_ipv6('::1') is intern_ipv6('::1')
+  True
+
 """
 
+import sys
+
+from array import array
+from bisect import bisect_right
+from itertools import islice, izip
+from socket import AF_INET, AF_INET6, error as SocketError
+from socket import inet_ntop, inet_pton
+from struct import Struct
+
 from ipaddr import IPv6Address as UtilityClass
+from pyutil.cache import CachingDict
 
 # ------------------------------------------------------------------------------
 # Helper Objects
 # ------------------------------------------------------------------------------
 
 compress_hextets = UtilityClass(0)._compress_hextets
+pack_ipv4 = Struct('!I').pack
+
+MASK32 = (2 ** 32) - 1
+MASK64 = (2 ** 64) - 1
 
 class InvalidIPAddress(ValueError):
     pass
@@ -60,7 +181,9 @@ class InvalidIPAddress(ValueError):
 
 class IPv4(long):
 
-    ip_str = None
+    __slots__ = ()
+
+    bits = 32
     max_ip = (2 ** 32) - 1
 
     def __new__(klass, ip, int_types=(int, long)):
@@ -80,19 +203,10 @@ class IPv4(long):
             if not 0 <= octet <= 255:
                 raise InvalidIPAddress(ip)
             ip_val = (ip_val << 8) | octet
-        self = super(IPv4, klass).__new__(klass, ip_val)
-        self.ip_str = ip
-        return self
+        return super(IPv4, klass).__new__(klass, ip_val)
 
     def __repr__(self):
-        if not self.ip_str:
-            ip_val = self
-            octets = []; out = octets.append
-            for i in range(4):
-                out(str(ip_val & 255))
-                ip_val >>= 8
-            self.ip_str = '.'.join(octets[::-1])
-        return self.ip_str
+        return inet_ntop(AF_INET, pack_ipv4(self))
 
 # ------------------------------------------------------------------------------
 # IPv6 Address
@@ -100,7 +214,9 @@ class IPv4(long):
 
 class IPv6(long):
 
-    ip_str = None
+    __slots__ = ()
+
+    bits = 128
     max_ip = (2 ** 128) - 1
 
     def __new__(klass, ip, int_types=(int, long)):
@@ -151,18 +267,569 @@ class IPv6(long):
 
         return super(IPv6, klass).__new__(klass, ip_val)
 
-    def __repr__(self):
-        if not self.ip_str:
-            hex_str = '%032x' % self
-            hextets = ['%x' % int(hex_str[x:x+4], 16) for x in range(0, 32, 4)]
-            self.ip_str = ':'.join(compress_hextets(hextets))
-        return self.ip_str
-
-    def get_teredo_ipv4_address(self, prefix='20010000'):
-        ip = '%032x' % self
-        if ip[:8] != prefix:
+    def __repr__(self, shifts=range(112, -16, -16)):
+        return ':'.join(compress_hextets([
+            '%x' % ((self >> shift) & 65535) for shift in shifts
+            ]))
+
+    def get_teredo_ipv4_address(self):
+        if (self >> 96) != 0x20010000:
             return
-        return IPv4(int('0x' + ip[-8:], 16) ^ 0xffffffff)
+        return IPv4((self & MASK32) ^ MASK32)
+
+    def get_embedded_ipv4_address(self):
+        """Return the IPv4 address embedded by a transition mechanism."""
+        kind = classify_ipv6(self)
+        if kind == 'teredo':
+            return IPv4((self & MASK32) ^ MASK32)
+        if kind == '6to4':
+            return IPv4((self >> 80) & MASK32)
+        if kind == 'nat64':
+            for prefix, mask, network in NAT64_NETWORKS:
+                if self & mask == network:
+                    return IPv4(extract_nat64_ipv4(self, prefix))
+        if kind in IPV6_EMBEDDING_TYPES:
+            return IPv4(self & MASK32)
+
+    def classify(self):
+        """Return the type of special-purpose address, if any."""
+        return classify_ipv6(self)
+
+IP_CLASSES = {4: IPv4, 6: IPv6}
+
+# ------------------------------------------------------------------------------
+# IPv6 Classification
+# ------------------------------------------------------------------------------
+
+IPV6_PREFIXES = [
+    ('::/128', 'unspecified'),
+    ('::1/128', 'loopback'),
+    ('::ffff:0:0/96', 'ipv4-mapped'),
+    ('64:ff9b::/96', 'nat64'),
+    ('64:ff9b:1::/48', 'nat64'),
+    ('2001::/32', 'teredo'),
+    ('2001:db8::/32', 'documentation'),
+    ('3fff::/20', 'documentation'),
+    ('2002::/16', '6to4'),
+    ('fc00::/7', 'ula'),
+    ('fe80::/10', 'link-local'),
+    ('ff00::/8', 'multicast'),
+    ]
+
+IPV6_EMBEDDING_TYPES = frozenset(['ipv4-mapped', 'nat64'])
+
+def compile_prefix_table(prefixes, version=6):
+    """Return a list of ``(mask, {network: type})`` pairs, longest mask first."""
+
+    klass = IP_CLASSES[version]
+    table = {}
+
+    for network, kind in prefixes:
+        ip, prefix = network.split('/', 1)
+        prefix = int(prefix)
+        mask = klass.max_ip ^ ((1 << (klass.bits - prefix)) - 1)
+        networks = table.setdefault(prefix, (mask, {}))[1]
+        networks[long(klass(ip)) & mask] = kind
+
+    return [table[prefix] for prefix in sorted(table, reverse=True)]
+
+IPV6_PREFIX_TABLE = compile_prefix_table(IPV6_PREFIXES)
+
+NAT64_NETWORKS = []
+
+for _network, _kind in IPV6_PREFIXES:
+    if _kind == 'nat64':
+        _ip, _prefix = _network.split('/', 1)
+        _prefix = int(_prefix)
+        _mask = IPv6.max_ip ^ ((1 << (128 - _prefix)) - 1)
+        NAT64_NETWORKS.append((_prefix, _mask, long(IPv6(_ip)) & _mask))
+
+NAT64_NETWORKS.sort(reverse=True)
+del _network, _kind, _ip, _prefix, _mask
+
+def extract_nat64_ipv4(ip, prefix):
+    """Return the IPv4 value embedded after a NAT64 ``prefix`` (RFC 6052)."""
+
+    if prefix == 96:
+        return ip & MASK32
+
+    # Bits 64-71 are the reserved u-octet, which the IPv4 address skips over.
+    octets = [(ip >> shift) & 255 for shift in range(120, -8, -8)]
+    start = prefix / 8
+    octets = octets[start:8] + octets[9:9 + start - 4]
+    value = 0
+    for octet in octets:
+        value = (value << 8) | octet
+
+    return value
+
+def classify_ipv6(ip, table=IPV6_PREFIX_TABLE):
+    """Return the special-purpose type of the given IPv6 value, if any."""
+    for mask, networks in table:
+        kind = networks.get(ip & mask)
+        if kind:
+            return kind
+
+
+def classify_ipv6_many(ips, table=IPV6_PREFIX_TABLE):
+    """Return the types for a sequence of IPv6 strings and/or integers."""
+
+    # Each element is checked so that strings can be mixed with IPv6 objects
+    # or integers, while still being parsed together in bulk.
+    ips = list(ips)
+    strings = [idx for idx, ip in enumerate(ips) if isinstance(ip, basestring)]
+    if strings:
+        values = parse_ipv6_many([ips[idx] for idx in strings])
+        for idx, value in zip(strings, values):
+            ips[idx] = value
+
+    results = []; append = results.append
+
+    for ip in ips:
+        for mask, networks in table:
+            kind = networks.get(ip & mask)
+            if kind:
+                break
+        append(kind)
+
+    return results
+
+# ------------------------------------------------------------------------------
+# Interning Constructors
+# ------------------------------------------------------------------------------
+
+IPV4_CACHE = CachingDict(100000)
+IPV6_CACHE = CachingDict(100000)
+
+def intern_ipv4(ip, cache=IPV4_CACHE):
+    """Return a shared ``IPv4`` instance for the given ``ip``."""
+    value = cache.get(ip)
+    if value is None:
+        value = cache[ip] = IPv4(ip)
+    return value
+
+
+def intern_ipv6(ip, cache=IPV6_CACHE):
+    """Return a shared ``IPv6`` instance for the given ``ip``."""
+    value = cache.get(ip)
+    if value is None:
+        value = cache[ip] = IPv6(ip)
+    return value
+
+# ------------------------------------------------------------------------------
+# Batch Parsing & Formatting
+# ------------------------------------------------------------------------------
+
+REQUIRED = object()
+
+pack_ipv6 = Struct('!QQ').pack
+unpack_ipv6 = Struct('!QQ').unpack
+swap_bytes = sys.byteorder == 'little'
+
+def parse_ipv4_many(ips, default=REQUIRED):
+    """Return a list of the integer values for the given IPv4 strings."""
+
+    ips = list(ips)
+    values = array('I')
+
+    # The fast path packs everything via the C functions in one go and only
+    # falls back to per-item handling if any of the values are unusual.
+    try:
+        values.fromstring(''.join([inet_pton(AF_INET, ip) for ip in ips]))
+    except (SocketError, TypeError, ValueError):
+        return [parse_ip(ip, AF_INET, default) for ip in ips]
+
+    if swap_bytes:
+        values.byteswap()
+
+    return map(long, values)
+
+
+def parse_ipv6_many(ips, default=REQUIRED):
+    """Return a list of the integer values for the given IPv6 strings."""
+
+    values = []; append = values.append
+
+    for ip in ips:
+        try:
+            high, low = unpack_ipv6(inet_pton(AF_INET6, ip))
+        except (SocketError, TypeError, ValueError):
+            append(parse_ip(ip, AF_INET6, default))
+            continue
+        append((long(high) << 64) | low)
+
+    return values
+
+
+def parse_ip(ip, family, default=REQUIRED):
+    """Parse a value rejected by ``inet_pton`` using the IP classes."""
+
+    try:
+        if family == AF_INET:
+            return long(IPv4(ip))
+        return long(IPv6(ip))
+    except Exception:
+        if default is REQUIRED:
+            raise InvalidIPAddress(ip)
+        return default
+
+
+def format_ipv4_many(values):
+    """Return a list of IPv4 strings for the given integer values."""
+
+    values = array('I', values)
+    if swap_bytes:
+        values.byteswap()
+
+    packed = values.tostring()
+    return [
+        inet_ntop(AF_INET, packed[idx:idx+4])
+        for idx in xrange(0, len(packed), 4)
+        ]
+
+
+def format_ipv6_many(values):
+    """
+    Return a list of IPv6 strings for the given integer values.
+
+    Note that, unlike ``IPv6.__repr__``, the platform's ``inet_ntop`` will
+    render IPv4-mapped/compatible addresses using the dotted quad notation.
+
+    """
+
+    return [
+        inet_ntop(AF_INET6, pack_ipv6(value >> 64, value & MASK64))
+        for value in values
+        ]
+
+IP_PARSERS = {4: parse_ipv4_many, 6: parse_ipv6_many}
+
+# ------------------------------------------------------------------------------
+# Compact Address Storage
+# ------------------------------------------------------------------------------
+
+class Uint128Array(object):
+    """A compact sequence of 128-bit unsigned ints backed by ``array('I')``."""
+
+    __slots__ = ('words',)
+
+    def __init__(self, values=()):
+        self.words = words = array('I')
+        extend = words.extend
+        for value in values:
+            extend((
+                (value >> 96) & MASK32, (value >> 64) & MASK32,
+                (value >> 32) & MASK32, value & MASK32
+                ))
+
+    def __len__(self):
+        return len(self.words) >> 2
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+            if idx < 0:
+                raise IndexError(idx)
+        words = self.words
+        idx <<= 2
+        return (
+            (words[idx] << 96) | (words[idx+1] << 64) |
+            (words[idx+2] << 32) | words[idx+3]
+            )
+
+
+def create_array(values, version=4):
+    """Return a compact array of the given sorted address ``values``."""
+
+    if version == 4:
+        return array('I', values)
+    return Uint128Array(values)
+
+
+def parse_network(spec, version=4):
+    """Return the ``(start, end)`` values for an address, CIDR or range."""
+
+    klass = IP_CLASSES[version]
+    spec = spec.strip()
+
+    if '/' in spec:
+        ip, prefix = spec.split('/', 1)
+        ip = klass(ip)
+        try:
+            prefix = int(prefix, 10)
+        except ValueError:
+            raise InvalidIPAddress(spec)
+        if not 0 <= prefix <= klass.bits:
+            raise InvalidIPAddress(spec)
+        hostmask = (1 << (klass.bits - prefix)) - 1
+        start = long(ip) & (klass.max_ip ^ hostmask)
+        return start, start | hostmask
+
+    if '-' in spec:
+        start, end = spec.split('-', 1)
+        start, end = long(klass(start.strip())), long(klass(end.strip()))
+        if start > end:
+            raise InvalidIPAddress(spec)
+        return start, end
+
+    ip = long(klass(spec))
+    return ip, ip
+
+
+def read_entries(source):
+    """Yield the non-empty, non-comment entries from a file or path."""
+
+    if isinstance(source, basestring):
+        source = open(source, 'rb')
+        close = True
+    else:
+        close = False
+
+    try:
+        for line in source:
+            if '#' in line:
+                line = line.split('#', 1)[0]
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if close:
+            source.close()
+
+# ------------------------------------------------------------------------------
+# IP Sets
+# ------------------------------------------------------------------------------
+
+class IPSet(object):
+    """A set of individual IP addresses stored in a sorted compact array."""
+
+    def __init__(self, ips=(), version=4):
+        if version not in IP_CLASSES:
+            raise ValueError("Unknown IP version: %r" % version)
+        self.klass = IP_CLASSES[version]
+        self.version = version
+        self.values = create_array((), version)
+        self.pending = []
+        for ip in ips:
+            self.add(ip)
+
+    def add(self, ip):
+        self.pending.append(long(self.klass(ip)))
+
+    def load(self, source):
+        """Add the addresses listed in the given file or path."""
+        self.pending.extend(IP_PARSERS[self.version](read_entries(source)))
+        self.compact()
+
+    def compact(self):
+        """Merge any pending additions into the sorted array."""
+        if not self.pending:
+            return
+        values = set(self.values)
+        values.update(self.pending)
+        self.values = create_array(sorted(values), self.version)
+        self.pending = []
+
+    def __contains__(self, ip):
+        if self.pending:
+            self.compact()
+        try:
+            ip = long(self.klass(ip))
+        except ValueError:
+            return False
+        values = self.values
+        idx = bisect_right(values, ip)
+        return bool(idx) and values[idx-1] == ip
+
+    def __iter__(self):
+        if self.pending:
+            self.compact()
+        klass = self.klass
+        for value in self.values:
+            yield klass(value)
+
+    def __len__(self):
+        if self.pending:
+            self.compact()
+        return len(self.values)
+
+# ------------------------------------------------------------------------------
+# IP Range Indexes
+# ------------------------------------------------------------------------------
+
+class IPRangeIndex(object):
+    """An index of merged IP address ranges stored in sorted compact arrays."""
+
+    def __init__(self, networks=(), version=4):
+        if version not in IP_CLASSES:
+            raise ValueError("Unknown IP version: %r" % version)
+        self.klass = IP_CLASSES[version]
+        self.version = version
+        self.starts = create_array((), version)
+        self.ends = create_array((), version)
+        self.pending = []
+        for network in networks:
+            self.add(network)
+
+    def add(self, network):
+        """Add an address, CIDR network or ``start-end`` range."""
+        self.pending.append(parse_network(network, self.version))
+
+    def add_range(self, start, end):
+        klass = self.klass
+        start, end = long(klass(start)), long(klass(end))
+        if start > end:
+            raise InvalidIPAddress((start, end))
+        self.pending.append((start, end))
+
+    def load(self, source):
+        """Add the networks listed in the given file or path."""
+        version = self.version
+        self.pending.extend(
+            parse_network(network, version) for network in read_entries(source)
+            )
+        self.compact()
+
+    def compact(self):
+        """Merge any pending additions into the sorted range arrays."""
+
+        if not self.pending:
+            return
+
+        ranges = self.pending
+        ranges.extend(zip(self.starts, self.ends))
+        ranges.sort()
+
+        starts = []; add_start = starts.append
+        ends = []; add_end = ends.append
+        current_start, current_end = ranges[0]
+
+        for start, end in ranges:
+            if start <= current_end + 1:
+                if end > current_end:
+                    current_end = end
+                continue
+            add_start(current_start)
+            add_end(current_end)
+            current_start, current_end = start, end
+
+        add_start(current_start)
+        add_end(current_end)
+
+        self.starts = create_array(starts, self.version)
+        self.ends = create_array(ends, self.version)
+        self.pending = []
+
+    def __contains__(self, ip):
+        if self.pending:
+            self.compact()
+        try:
+            ip = long(self.klass(ip))
+        except ValueError:
+            return False
+        idx = bisect_right(self.starts, ip)
+        return bool(idx) and ip <= self.ends[idx-1]
+
+    def __iter__(self):
+        if self.pending:
+            self.compact()
+        klass = self.klass
+        for start, end in izip(self.starts, self.ends):
+            yield klass(start), klass(end)
+
+    def __len__(self):
+        if self.pending:
+            self.compact()
+        return len(self.starts)
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+
+def get_benchmark_lines(count, version=4, seed=0):
+    """Yield ``count`` synthetic access log lines for the given IP version."""
+
+    from random import Random
+
+    randint = Random(seed).randint
+    if version == 4:
+        for _ in xrange(count):
+            yield '%d.%d.%d.%d - - [19/Oct/2010:06:25:21 +0000] "GET / ' \
+                'HTTP/1.1" 200 512' % (
+                randint(1, 223), randint(0, 255), randint(0, 255),
+                randint(1, 254)
+                )
+    else:
+        for _ in xrange(count):
+            yield '2001:db8:%x:%x:%x:%x:%x:%x - - [19/Oct/2010:06:25:21 ' \
+                '+0000] "GET / HTTP/1.1" 200 512' % tuple(
+                randint(1, 65535) for _ in xrange(6)
+                )
+
+def benchmark(lines=10000000, ipv6_lines=None, chunk_size=100000):
+    """
+    Time the batch functions against the per-object constructors.
+
+    The IP addresses are taken from the first column of ``lines`` synthetic
+    IPv4 log lines and ``ipv6_lines`` IPv6 ones (a quarter of ``lines`` by
+    default). These are processed in chunks of ``chunk_size`` so that memory
+    use stays bounded.
+
+    """
+
+    from time import time
+
+    if ipv6_lines is None:
+        ipv6_lines = lines / 4
+
+    results = {'ipv4_lines': lines, 'ipv6_lines': ipv6_lines}
+    identical = True
+
+    for version, count in ((4, lines), (6, ipv6_lines)):
+
+        klass = IP_CLASSES[version]
+        parse_many = IP_PARSERS[version]
+        if version == 4:
+            format_many = format_ipv4_many
+        else:
+            format_many = format_ipv6_many
+
+        timings = dict.fromkeys(
+            ['parse_single', 'parse_batch', 'format_single', 'format_batch'],
+            0.0
+            )
+
+        source = get_benchmark_lines(count, version)
+        while 1:
+            ips = [line.split(' ', 1)[0] for line in islice(source, chunk_size)]
+            if not ips:
+                break
+
+            start = time()
+            single = [long(klass(ip)) for ip in ips]
+            timings['parse_single'] += time() - start
+
+            start = time()
+            batch = parse_many(ips)
+            timings['parse_batch'] += time() - start
+
+            identical = identical and single == batch
+
+            start = time()
+            single = [repr(klass(value)) for value in batch]
+            timings['format_single'] += time() - start
+
+            start = time()
+            batch = format_many(batch)
+            timings['format_batch'] += time() - start
+
+            identical = identical and single == batch
+
+        for key, value in timings.iteritems():
+            results['ipv%d_%s' % (version, key)] = value
+
+    results['identical'] = identical
+    return results
 
 
 if __name__ == '__main__':
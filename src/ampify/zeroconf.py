@@ -8,6 +8,13 @@ ZeroConf Support
 
 This module provides support functions to register and query ZeroConf records.
 
+The actual work is done by a pluggable backend. By default, ``BonjourBackend``
+is used if ``pybonjour`` is available. Otherwise, the functions simply return
+empty values -- unless an alternative backend has been set, e.g. the in-process
+``LoopbackBackend``, which is useful for testing and load simulations:
+
+  >>> set_backend(LoopbackBackend())
+
 The ``register`` function returns either a ``1`` or a ``0`` to indicate a
 successful or failed registration.
 
@@ -21,102 +28,518 @@ second parameter, e.g.
   >>> query('_test._tcp', 1.0)
   {u'foo._test._tcp.local.': {...'port': 1234...}}
 
+The ``query`` function blocks for the full ``timeout``. Long-running processes
+should instead use a ``Browser``, which keeps a live cache of the services for
+a ``regtype`` up-to-date from a background thread:
+
+  >>> browser = Browser('_test._tcp')
+  >>> browser.start()
+
+The ``lookup`` function uses a shared browser per ``regtype``, so only the
+very first call waits for the initial results -- all subsequent calls are
+simply reads from the cache:
+
+  >>> lookup('_test._tcp')
+  {u'foo._test._tcp.local.': {...'port': 1234...}}
+
+Cached records are re-resolved once they are older than the browser's ``ttl``
+and are dropped if they can no longer be resolved. You can be notified of any
+changes by adding callbacks which get called with the ``event``, i.e. one of
+``'added'``, ``'updated'`` or ``'removed'``, the service's full name and its
+record:
+
+  >>> def on_change(event, fullname, record):
+  ...     print event, fullname
+
+  >>> browser.add_callback(on_change)
+  >>> browser.stop(wait=2.0)
+
 """
 
 import atexit
 import threading
 
+from Queue import Empty, Queue
 from select import select
-from time import time
+from time import sleep, time
+from traceback import print_exc
 
 try:
     import pybonjour
 except Exception:
     pybonjour = None
 
-state = threading.local()
-state.announce = None
-state.query = None
-state.current = None
-state.timeout = None
+# ------------------------------------------------------------------------------
+# Bonjour Backend
+# ------------------------------------------------------------------------------
 
-def registration_callback(sdRef, flags, errorCode, name, regtype, domain):
-    if errorCode == pybonjour.kDNSServiceErr_NoError:
-        state.announce = 1
-    else:
-        state.announce = 0
+class BonjourBackend(object):
+    """Discovery backend which uses the system's Bonjour/Avahi daemon."""
 
-def register(name, regtype, port):
-    if not pybonjour:
-        return
-    sdRef = pybonjour.DNSServiceRegister(
-        name=name, regtype=regtype, port=port, callBack=registration_callback
-        )
-    try:
-        while 1:
-            ready = select([sdRef], [], [])
+    def register(self, name, regtype, port):
+        result = []
+        def registration_callback(
+            sdRef, flags, errorCode, name, regtype, domain
+            ):
+            if errorCode == pybonjour.kDNSServiceErr_NoError:
+                result.append(1)
+            else:
+                result.append(0)
+        sdRef = pybonjour.DNSServiceRegister(
+            name=name, regtype=regtype, port=port,
+            callBack=registration_callback
+            )
+        try:
+            while 1:
+                ready = select([sdRef], [], [])
+                if sdRef in ready[0]:
+                    pybonjour.DNSServiceProcessResult(sdRef)
+                    return result and result[0]
+        finally:
+            atexit.register(sdRef.close)
+
+    def browse(self, regtype, callback):
+        def browse_callback(
+            sdRef, flags, interfaceIndex, errorCode, serviceName, regtype,
+            replyDomain
+            ):
+            if errorCode != pybonjour.kDNSServiceErr_NoError:
+                return
+            callback(
+                flags & pybonjour.kDNSServiceFlagsAdd,
+                (interfaceIndex, serviceName, regtype, replyDomain)
+                )
+        return BonjourBrowseHandle(pybonjour.DNSServiceBrowse(
+            regtype=regtype, callBack=browse_callback
+            ))
+
+    def resolve(self, source, timeout=None):
+        interfaceIndex, serviceName, regtype, replyDomain = source
+        result = []
+        def resolve_callback(
+            sdRef, flags, interfaceIndex, errorCode, fullname, hosttarget,
+            port, txtRecord
+            ):
+            if errorCode == pybonjour.kDNSServiceErr_NoError:
+                result.append((fullname, {
+                    'name': serviceName,
+                    'type': regtype,
+                    'host': hosttarget,
+                    'port': port
+                    }))
+        sdRef = pybonjour.DNSServiceResolve(
+            0, interfaceIndex, serviceName, regtype, replyDomain,
+            resolve_callback
+            )
+        try:
+            ready = select([sdRef], [], [], timeout)
             if sdRef in ready[0]:
                 pybonjour.DNSServiceProcessResult(sdRef)
-                return state.announce
-    finally:
-        state.announce = None
-        atexit.register(sdRef.close)
-
-def resolve_callback(
-    sdRef, flags, interfaceIndex, errorCode, fullname, hosttarget, port,
-    txtRecord
-    ):
-    if errorCode == pybonjour.kDNSServiceErr_NoError:
-        record = state.query[fullname] = state.current
-        record['host'] = hosttarget
-        record['port'] = port
-
-def query_callback(
-    sdRef, flags, interfaceIndex, errorCode, serviceName, regtype, replyDomain
-    ):
-    if errorCode != pybonjour.kDNSServiceErr_NoError:
-        return
-    if not (flags & pybonjour.kDNSServiceFlagsAdd):
-        return
-    if state.timeout:
-        timeout = state.timeout
-    else:
-        timeout = None
-    state.current = {
-        'name': serviceName,
-        'type': regtype
-        }
-    sdRef = pybonjour.DNSServiceResolve(
-        0, interfaceIndex, serviceName, regtype, replyDomain, resolve_callback
-        )
-    try:
+        finally:
+            sdRef.close()
+        if result:
+            return result[0]
+        return None, None
+
+
+class BonjourBrowseHandle(object):
+
+    def __init__(self, sdRef):
+        self.sdRef = sdRef
+
+    def process(self, timeout=None):
+        """Dispatch any browse events and return whether there were any."""
+        sdRef = self.sdRef
+        ready = select([sdRef], [], [], timeout)
+        if sdRef in ready[0]:
+            pybonjour.DNSServiceProcessResult(sdRef)
+            return True
+        return False
+
+    def close(self):
+        self.sdRef.close()
+
+# ------------------------------------------------------------------------------
+# Loopback Backend
+# ------------------------------------------------------------------------------
+
+class LoopbackBackend(object):
+    """Pure-Python, in-process discovery backend."""
+
+    def __init__(self, domain='local.', host='localhost.', latency=0):
+        self.domain = domain
+        self.host = host
+        self.latency = latency
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.services = {}
+
+    def register(self, name, regtype, port):
+        regtype = regtype.rstrip('.') + '.'
+        self.lock.acquire()
+        try:
+            self.services.setdefault(regtype, {})[name] = port
+            handles = self.handles.get(regtype, [])[:]
+        finally:
+            self.lock.release()
+        for handle in handles:
+            handle.queue.put((1, (0, name, regtype, self.domain)))
+        return 1
+
+    def unregister(self, name, regtype):
+        regtype = regtype.rstrip('.') + '.'
+        self.lock.acquire()
+        try:
+            services = self.services.get(regtype, {})
+            if name not in services:
+                return
+            del services[name]
+            handles = self.handles.get(regtype, [])[:]
+        finally:
+            self.lock.release()
+        for handle in handles:
+            handle.queue.put((0, (0, name, regtype, self.domain)))
+
+    def browse(self, regtype, callback):
+        regtype = regtype.rstrip('.') + '.'
+        handle = LoopbackBrowseHandle(self, regtype, callback)
+        self.lock.acquire()
+        try:
+            self.handles.setdefault(regtype, []).append(handle)
+            for name in self.services.get(regtype, ()):
+                handle.queue.put((1, (0, name, regtype, self.domain)))
+        finally:
+            self.lock.release()
+        return handle
+
+    def resolve(self, source, timeout=None):
+        _, name, regtype, domain = source
+        if self.latency:
+            sleep(self.latency)
+        port = self.services.get(regtype, {}).get(name)
+        if port is None:
+            return None, None
+        return u'%s.%s%s' % (name, regtype, domain), {
+            'name': name,
+            'type': regtype,
+            'host': self.host,
+            'port': port
+            }
+
+
+class LoopbackBrowseHandle(object):
+
+    def __init__(self, backend, regtype, callback):
+        self.backend = backend
+        self.callback = callback
+        self.queue = Queue()
+        self.regtype = regtype
+
+    def process(self, timeout=None):
+        """Dispatch any browse events and return whether there were any."""
+        queue = self.queue
+        try:
+            event = queue.get(True, timeout)
+        except Empty:
+            return False
         while 1:
-            ready = select([sdRef], [], [], timeout)
-            if sdRef not in ready[0]:
-                break
-            return pybonjour.DNSServiceProcessResult(sdRef)
-    finally:
-        state.current = None
-        sdRef.close()
+            self.callback(*event)
+            try:
+                event = queue.get_nowait()
+            except Empty:
+                return True
+
+    def close(self):
+        backend = self.backend
+        backend.lock.acquire()
+        try:
+            handles = backend.handles.get(self.regtype, [])
+            if self in handles:
+                handles.remove(self)
+        finally:
+            backend.lock.release()
+
+# ------------------------------------------------------------------------------
+# Backend Selection
+# ------------------------------------------------------------------------------
+
+if pybonjour:
+    BACKEND = BonjourBackend()
+else:
+    BACKEND = None
+
+def get_backend():
+    return BACKEND
+
+
+def set_backend(backend):
+    """Set the discovery backend and stop any browsers using the old one."""
+    global BACKEND
+    BACKEND = backend
+    stop_browsers()
+
+# ------------------------------------------------------------------------------
+# Registration & Querying
+# ------------------------------------------------------------------------------
+
+def register(name, regtype, port):
+    if not BACKEND:
+        return
+    return BACKEND.register(name, regtype, port)
+
+
+def resolve(source, timeout=None):
+    """Resolve a browsed service and return a ``(fullname, record)`` pair."""
+    return BACKEND.resolve(source, timeout)
+
 
 def query(regtype, timeout=5.0):
-    if not pybonjour:
+    if not BACKEND:
         return {}
-    sdRef = pybonjour.DNSServiceBrowse(regtype=regtype, callBack=query_callback)
+    backend = BACKEND
+    results = {}
+    def query_callback(added, source):
+        if not added:
+            return
+        fullname, record = backend.resolve(source, timeout or None)
+        if fullname:
+            results[fullname] = record
+    handle = backend.browse(regtype, query_callback)
     start = time()
-    if timeout:
-        state.timeout = timeout
-    state.query = {}
     try:
         while (time() - start) <= timeout:
-            ready = select([sdRef], [], [], timeout)
-            if sdRef in ready[0]:
-                pybonjour.DNSServiceProcessResult(sdRef)
-        return state.query
+            handle.process(timeout)
+        return results
     finally:
-        state.query = None
-        state.timeout = None
-        sdRef.close()
+        handle.close()
+
+# ------------------------------------------------------------------------------
+# Background Browsing
+# ------------------------------------------------------------------------------
+
+class Browser(object):
+    """Maintain a live cache of the services for a ``regtype``."""
+
+    def __init__(
+        self, regtype, ttl=120.0, interval=1.0, timeout=5.0, backend=None
+        ):
+        self.regtype = regtype
+        self.ttl = ttl
+        self.interval = interval
+        self.timeout = timeout
+        self.backend = backend
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.running = False
+        self.services = {}
+        self.sources = {}
+        self.thread = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def notify(self, event, fullname, record):
+        for callback in self.callbacks:
+            # A broken callback shouldn't stop the browser thread or any of the
+            # other callbacks, but its error is still reported.
+            try:
+                callback(event, fullname, record)
+            except Exception:
+                print_exc()
+
+    def start(self):
+        if self.running:
+            return
+        if not self.backend:
+            self.backend = BACKEND
+        if not self.backend:
+            return
+        self.running = True
+        self.thread = thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self, wait=None):
+        self.running = False
+        if wait and self.thread:
+            self.thread.join(wait)
+
+    def get_services(self, wait=None):
+        """Return a copy of the currently known services."""
+        if wait:
+            self.ready.wait(wait)
+        self.lock.acquire()
+        try:
+            return dict(
+                (fullname, record.copy())
+                for fullname, (record, _) in self.services.iteritems()
+                )
+        finally:
+            self.lock.release()
+
+    def update(self, fullname, record, source):
+        self.lock.acquire()
+        try:
+            existing = self.services.get(fullname)
+            self.services[fullname] = (record, time())
+            self.sources[fullname] = source
+        finally:
+            self.lock.release()
+        if existing is None:
+            self.notify('added', fullname, record)
+        elif existing[0] != record:
+            self.notify('updated', fullname, record)
+
+    def remove(self, fullname):
+        self.lock.acquire()
+        try:
+            existing = self.services.pop(fullname, None)
+            self.sources.pop(fullname, None)
+        finally:
+            self.lock.release()
+        if existing is not None:
+            self.notify('removed', fullname, existing[0])
+
+    def browse_callback(self, added, source):
+        if not added:
+            for fullname, existing in self.sources.items():
+                if existing == source:
+                    self.remove(fullname)
+            return
+        fullname, record = self.backend.resolve(source, self.timeout)
+        if fullname:
+            self.update(fullname, record, source)
+
+    def expire(self):
+        """Re-resolve stale records and drop any which no longer resolve."""
+        cutoff = time() - self.ttl
+        self.lock.acquire()
+        try:
+            stale = [
+                (fullname, self.sources[fullname])
+                for fullname, (_, updated) in self.services.iteritems()
+                if updated < cutoff
+                ]
+        finally:
+            self.lock.release()
+        for fullname, source in stale:
+            resolved, record = self.backend.resolve(source, self.timeout)
+            if resolved:
+                self.update(resolved, record, source)
+            else:
+                self.remove(fullname)
+
+    def run(self):
+        handle = self.backend.browse(self.regtype, self.browse_callback)
+        start = time()
+        try:
+            while self.running:
+                if not handle.process(self.interval):
+                    # The initial burst of results has been processed.
+                    self.ready.set()
+                if (time() - start) >= self.timeout:
+                    self.ready.set()
+                self.expire()
+        finally:
+            self.ready.set()
+            handle.close()
+
+# ------------------------------------------------------------------------------
+# Shared Browsers
+# ------------------------------------------------------------------------------
+
+BROWSERS = {}
+BROWSERS_LOCK = threading.Lock()
+
+def get_browser(regtype):
+    """Return a started ``Browser`` for the given ``regtype``."""
+    BROWSERS_LOCK.acquire()
+    try:
+        if regtype not in BROWSERS:
+            browser = BROWSERS[regtype] = Browser(regtype)
+            browser.start()
+        return BROWSERS[regtype]
+    finally:
+        BROWSERS_LOCK.release()
+
+
+def stop_browsers(wait=None):
+    """Stop and forget all of the shared browsers."""
+    BROWSERS_LOCK.acquire()
+    try:
+        browsers = BROWSERS.values()
+        BROWSERS.clear()
+    finally:
+        BROWSERS_LOCK.release()
+    for browser in browsers:
+        browser.stop(wait)
+
+atexit.register(stop_browsers, 2.0)
+
+
+def lookup(regtype, wait=5.0):
+    """Return the cached services for the given ``regtype``."""
+    if not BACKEND:
+        return {}
+    return get_browser(regtype).get_services(wait)
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+
+def benchmark(count=500, backend=None, regtype='_ampbench._tcp', wait=30.0):
+    """Measure registration and discovery latency for ``count`` services."""
+
+    if backend is None:
+        backend = LoopbackBackend()
+
+    seen = {}
+    complete = threading.Event()
+
+    def on_change(event, fullname, record):
+        if event == 'added':
+            seen[record['name']] = time()
+            if len(seen) == count:
+                complete.set()
+
+    browser = Browser(regtype, interval=0.01, backend=backend)
+    browser.add_callback(on_change)
+    browser.start()
+
+    registered = {}
+    registration = []
+
+    try:
+        for idx in xrange(count):
+            name = 'service-%d' % idx
+            start = registered[name] = time()
+            backend.register(name, regtype, 10000 + idx)
+            registration.append(time() - start)
+        complete.wait(wait)
+    finally:
+        browser.stop(wait)
+
+    discovery = sorted(
+        seen[name] - registered[name] for name in seen if name in registered
+        )
+    registration.sort()
+
+    def summarise(timings):
+        if not timings:
+            return {}
+        return {
+            'mean': sum(timings) / len(timings),
+            'median': timings[len(timings) / 2],
+            'max': timings[-1]
+            }
+
+    return {
+        'services': count,
+        'discovered': len(discovery),
+        'registration': summarise(registration),
+        'discovery': summarise(discovery)
+        }
 
 if __name__ == '__main__':
     import doctest
@@ -8,7 +8,14 @@ from hmac2 import HMAC
 from hashlib import sha384
 from os import urandom
 from time import time
-from urllib import urlencode
+from urllib import quote_plus
+
+from pyutil.cache import CachingDict
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    compare_digest = None
 
 # ------------------------------------------------------------------------------
 # http://rdist.root.org/2009/05/28/timing-attack-in-google-keyczar-library/
@@ -17,6 +24,14 @@ from urllib import urlencode
 def secure_string_comparison(s1, s2, ord=ord):
     """Securely compare 2 strings in a manner which avoids timing attacks."""
 
+    # Use the C implementation on Python 2.7.7+ -- it only handles str/ascii
+    # unicode pairs, so we fall back to the pure Python loop otherwise.
+    if compare_digest:
+        try:
+            return compare_digest(s1, s2)
+        except TypeError:
+            pass
+
     if len(s1) != len(s2):
         return False
 
@@ -27,6 +42,123 @@ def secure_string_comparison(s1, s2, ord=ord):
 
     return total == 0
 
+# ------------------------------------------------------------------------------
+# keyed signers
+# ------------------------------------------------------------------------------
+
+TRANS_5C = ''.join([chr(x ^ 0x5C) for x in xrange(256)])
+TRANS_36 = ''.join([chr(x ^ 0x36) for x in xrange(256)])
+
+class Signer(object):
+    """An HMAC generator with the inner and outer key pads precomputed."""
+
+    __slots__ = ('hasher', 'inner', 'outer')
+
+    def __init__(self, key, hasher=sha384):
+        self.hasher = hasher
+        blocksize = getattr(hasher(), 'block_size', 64)
+        if len(key) > blocksize:
+            key = hasher(key).digest()
+        key = key + (chr(0) * (blocksize - len(key)))
+        self.inner = hasher(key.translate(TRANS_36))
+        self.outer = hasher(key.translate(TRANS_5C))
+
+    def digest(self, value):
+        inner = self.inner.copy()
+        inner.update(value)
+        outer = self.outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def encoded_mac(self, value):
+        return b64encode(self.digest(value), '-_').rstrip('=')
+
+    def check(self, mac, value):
+        return secure_string_comparison(mac, self.encoded_mac(value))
+
+
+SIGNERS = CachingDict(100)
+
+def get_signer(key, hasher=sha384, cache=SIGNERS):
+    """Return a, potentially cached, ``Signer`` for the given key."""
+
+    if isinstance(key, Signer):
+        return key
+
+    signer = cache.get((key, hasher))
+    if signer is None:
+        signer = cache[(key, hasher)] = Signer(key, hasher)
+
+    return signer
+
+# ------------------------------------------------------------------------------
+# key rotation
+# ------------------------------------------------------------------------------
+
+class Keyring(object):
+    """
+    A set of active keys which can be used in place of a single ``key``.
+
+    MACs are generated with the ``current`` key and are prefixed with its id,
+    e.g. ``2011a.<mac>``, so that validation can go straight to the right key.
+    Keys can therefore be rotated by adding a new current key and removing the
+    old one once any values signed with it have expired. MACs without an id
+    are checked against the optional ``legacy_key``.
+
+    """
+
+    def __init__(self, keys=(), current=None, legacy_key=None, hasher=sha384):
+        self.hasher = hasher
+        self.current = None
+        self.signers = {}
+        if isinstance(keys, dict):
+            keys = sorted(keys.items())
+        for key_id, key in keys:
+            self.add(key_id, key)
+        if current is not None:
+            self.set_current(current)
+        if legacy_key is None:
+            self.legacy = None
+        else:
+            self.legacy = Signer(legacy_key, hasher)
+
+    def add(self, key_id, key, current=False):
+        key_id = str(key_id)
+        if ('.' in key_id) or (':' in key_id) or not key_id:
+            raise ValueError("Invalid key id: %r" % key_id)
+        self.signers[key_id] = Signer(key, self.hasher)
+        if current or self.current is None:
+            self.current = key_id
+
+    def remove(self, key_id):
+        key_id = str(key_id)
+        if key_id == self.current:
+            raise ValueError("Cannot remove the current key: %r" % key_id)
+        del self.signers[key_id]
+
+    def set_current(self, key_id):
+        key_id = str(key_id)
+        if key_id not in self.signers:
+            raise KeyError(key_id)
+        self.current = key_id
+
+    def encoded_mac(self, value):
+        if self.current is None:
+            raise ValueError("The keyring doesn't have any keys.")
+        return "%s.%s" % (
+            self.current, self.signers[self.current].encoded_mac(value)
+            )
+
+    def check(self, mac, value):
+        key_id, sep, mac = mac.rpartition('.')
+        if sep:
+            signer = self.signers.get(key_id)
+        else:
+            signer = self.legacy
+        if signer is None:
+            return False
+        return signer.check(mac, value)
+
 # ------------------------------------------------------------------------------
 # tamper-proof value generation
 # ------------------------------------------------------------------------------
@@ -34,6 +166,12 @@ def secure_string_comparison(s1, s2, ord=ord):
 def create_encoded_mac(value, key, hmac=HMAC, hasher=sha384):
     """Return a base64-encoded MAC."""
 
+    if isinstance(key, Keyring):
+        return key.encoded_mac(value)
+
+    if hmac is HMAC or isinstance(key, Signer):
+        return get_signer(key, hasher).encoded_mac(value)
+
     digest = hmac(key, value, hasher).digest()
     return b64encode(digest, '-_').rstrip('=')
 
@@ -78,9 +216,13 @@ def validate_tamper_proof_string(
 
     named_value = "%s|%s" % (name.replace('|', r'\|'), value)
 
-    expected_mac = create_encoded_mac(named_value, key, hmac, hasher)
-    if not secure_string_comparison(mac, expected_mac):
-        return
+    if isinstance(key, Keyring):
+        if not key.check(mac, named_value):
+            return
+    else:
+        expected_mac = create_encoded_mac(named_value, key, hmac, hasher)
+        if not secure_string_comparison(mac, expected_mac):
+            return
 
     if timestamped:
         try:
@@ -93,31 +235,144 @@ def validate_tamper_proof_string(
 
     return value
 
+
+def validate_many(name, values, key, timestamped=False, hasher=sha384):
+    """Validate a batch of values, returning ``None`` for any invalid ones."""
+
+    if not isinstance(name, str):
+        raise ValueError("You can only tamper-proof str name/values.")
+
+    prefix = "%s|" % name.replace('|', r'\|')
+    now = time()
+
+    if isinstance(key, Keyring):
+        check = key.check
+    else:
+        check = get_signer(key, hasher).check
+
+    results = []; append = results.append
+
+    for value in values:
+
+        if not isinstance(value, str):
+            raise ValueError("You can only tamper-proof str name/values.")
+
+        mac, sep, value = value.partition(':')
+        if not (sep and check(mac, prefix + value)):
+            append(None)
+            continue
+
+        if timestamped:
+            timestamp, sep, value = value.partition(':')
+            try:
+                timestamp = int(timestamp)
+            except ValueError:
+                append(None)
+                continue
+            if (not sep) or (now > timestamp):
+                append(None)
+                continue
+
+        append(value)
+
+    return results
+
 # ------------------------------------------------------------------------------
 # pseudo-signature generation and validation
 # ------------------------------------------------------------------------------
 
-def create_signature_for_payload(payload, key):
+def encode_payload(payload, quote=quote_plus):
+    """Return the canonical encoding of the given payload for signing."""
+
+    # This matches the output of calling ``urlencode`` on each of the sorted
+    # key/value pairs and joining them with '&'.
+    return '&'.join([
+        "%s=%s" % (quote(str(key)), quote(str(payload[key])))
+        for key in sorted(payload)
+        ])
+
+
+class PayloadEncoder(object):
+    """A payload encoder which reuses the encodings of static fields."""
+
+    def __init__(self, static_fields):
+        self.static_fields = static_fields = dict(static_fields)
+        self.encoded_fields = dict(
+            (key, "%s=%s" % (quote_plus(str(key)), quote_plus(str(value))))
+            for key, value in static_fields.iteritems()
+            )
+
+    def __call__(self, payload, quote=quote_plus, missing=object()):
+        static_fields = self.static_fields
+        encoded_fields = self.encoded_fields
+        output = []; append = output.append
+        for key in sorted(payload):
+            value = payload[key]
+            static = static_fields.get(key, missing)
+            if static is value or (
+                type(static) is type(value) and static == value
+                ):
+                append(encoded_fields[key])
+            else:
+                append("%s=%s" % (quote(str(key)), quote(str(value))))
+        return '&'.join(output)
+
+
+def create_signature_for_payload(payload, key, encoder=encode_payload):
     """Return the signature for the given payload."""
-
-    payload_keys = sorted(payload.keys())
-    output = []; append = output.append
-
-    for payload_key in payload_keys:
-        append(urlencode({payload_key: payload[payload_key]}))
-
-    output = '&'.join(output)
-    return create_encoded_mac(output, key)
+    return create_encoded_mac(encoder(payload), key)
 
 
-def sign_payload(payload, key, nonce_name='nonce', nonce_size=20):
+def sign_payload(
+    payload, key, nonce_name='nonce', nonce_size=20, encoder=encode_payload
+    ):
     """Return a signature and a modified payload with a generated nonce."""
     payload[nonce_name] = b32encode(urandom(nonce_size))
-    return create_signature_for_payload(payload, key), payload
+    return create_signature_for_payload(payload, key, encoder), payload
 
 
-def validate_signed_payload(payload, key, signature):
+def validate_signed_payload(payload, key, signature, encoder=encode_payload):
     """Validate that the signature matches the given payload and key."""
-    expected_sig = create_signature_for_payload(payload, key)
+    if isinstance(key, Keyring):
+        if key.check(signature, encoder(payload)):
+            return payload
+        return
+    expected_sig = create_signature_for_payload(payload, key, encoder)
     if secure_string_comparison(signature, expected_sig):
         return payload
+
+# ------------------------------------------------------------------------------
+# benchmarking
+# ------------------------------------------------------------------------------
+
+def benchmark(count=100000, key='benchmark-key', invalid=2):
+    """Time ``validate_many`` against validating each of ``count`` tokens."""
+
+    tokens = [
+        create_tamper_proof_string('session', 'user-%d' % idx, key, 3600)
+        for idx in xrange(count)
+        ]
+
+    # Tamper with the MACs of a few of the tokens.
+    for idx in xrange(min(invalid, count)):
+        idx = idx * count / invalid
+        tokens[idx] = 'x' + tokens[idx][1:]
+
+    start = time()
+    single = [
+        validate_tamper_proof_string('session', token, key, True)
+        for token in tokens
+        ]
+    single_duration = time() - start
+
+    start = time()
+    batch = validate_many('session', tokens, key, True)
+    batch_duration = time() - start
+
+    return {
+        'tokens': count,
+        'invalid': batch.count(None),
+        'identical': single == batch,
+        'single': single_duration,
+        'batch': batch_duration
+        }
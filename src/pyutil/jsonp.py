@@ -9,6 +9,8 @@ import re
 
 from unicodedata import category
 
+from pyutil.cache import CachingDict
+
 # ------------------------------------------------------------------------------
 # javascript identifier unicode categories and "exceptional" chars
 # ------------------------------------------------------------------------------
@@ -23,6 +25,13 @@ valid_jsid_categories = frozenset([
 
 valid_jsid_chars = ('$', '_')
 
+# ------------------------------------------------------------------------------
+# regex for the common case of plain ascii identifiers
+# ------------------------------------------------------------------------------
+
+is_ascii_identifier = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*\Z').match
+is_ascii_string = re.compile(r'[\x00-\x7f]*\Z').match
+
 # ------------------------------------------------------------------------------
 # regex to find array[index] patterns
 # ------------------------------------------------------------------------------
@@ -62,6 +71,13 @@ def is_valid_javascript_identifier(identifier, escape=r'\u', ucd_cat=category):
     if not identifier:
         return False
 
+    # ASCII identifiers without escapes can be fully checked by a regex as none
+    # of the other chars are in the valid unicode categories.
+    if is_ascii_string(identifier) and escape not in identifier:
+        if not is_ascii_identifier(identifier):
+            return False
+        return not is_reserved_js_word(identifier)
+
     if not isinstance(identifier, unicode):
         try:
             identifier = unicode(identifier, 'utf-8')
@@ -102,9 +118,21 @@ def is_valid_javascript_identifier(identifier, escape=r'\u', ucd_cat=category):
     return True
 
 
-def is_valid_jsonp_callback_value(value):
+CALLBACK_CACHE = CachingDict(1000)
+
+def is_valid_jsonp_callback_value(value, cache=CALLBACK_CACHE):
     """Return whether the given ``value`` can be used as a JSON-P callback."""
 
+    valid = cache.get(value)
+    if valid is not None:
+        return valid
+
+    cache[value] = valid = _is_valid_jsonp_callback_value(value)
+    return valid
+
+
+def _is_valid_jsonp_callback_value(value):
+
     for identifier in value.split(u'.'):
         while '[' in identifier:
             if not has_valid_array_index(identifier):
@@ -115,6 +143,38 @@ def is_valid_jsonp_callback_value(value):
 
     return True
 
+# ------------------------------------------------------------------------------
+# benchmark
+# ------------------------------------------------------------------------------
+
+BENCHMARK_CALLBACKS = [
+    'jQuery1410234917_1281359812874', 'jsonp1281359812874', 'callback',
+    'YAHOO.util.Connect.handle', 'handlers[3]', '$.ajaxHandler[42][1].foo'
+    ]
+
+def benchmark(rounds=20000, callbacks=BENCHMARK_CALLBACKS):
+    """Time the validation of typical callbacks with and without caching."""
+
+    from time import time
+
+    start = time()
+    for _ in xrange(rounds):
+        for value in callbacks:
+            _is_valid_jsonp_callback_value(value)
+    uncached = time() - start
+
+    cache = CachingDict(1000)
+    start = time()
+    for _ in xrange(rounds):
+        for value in callbacks:
+            is_valid_jsonp_callback_value(value, cache)
+    cached = time() - start
+
+    return {
+        'calls': rounds * len(callbacks), 'uncached': uncached,
+        'cached': cached
+        }
+
 # ------------------------------------------------------------------------------
 # test
 # ------------------------------------------------------------------------------
@@ -130,6 +130,24 @@ dashes:
   >>> render_rst(text)
   u'<p>&ldquo;This is a quote&rdquo; &mdash; Gandhi</p>'
 
+The ``plan`` and ``tag`` directives are used to write planfiles. Along with the
+tagged items, the HTML output for a plan includes a ``PLAN_INDEX`` JSON index of
+the items and their tags, ids, deps and todo/done state for use by ``plan.js``:
+
+  >>> text = '''
+  ...
+  ... .. plan:: demo
+  ...
+  ... .. tag:: @tav, dep:setup, id:docs
+  ...
+  ...    Write the docs.
+  ...
+  ... '''
+
+  >>> output = render_rst(text)
+  >>> print output.split('</script>')[0]
+  <script type="text/javascript">var PLAN_INDEX = {"items":[{"deps":["demo-setup"],"id":"planitem-docs","plan":"demo","state":null,"tags":["tag-type-zuser-tag-val-tav"]}],"tags":{"tag-type-zuser-tag-val-tav":{"name":"@tav","norm":"@tav"}}};
+
 And, finally, in addition to the default directives, a ``syntax`` directive has
 been added which allows for the syntax highlighting of included source code in a
 variety of languages.
@@ -152,7 +170,11 @@ variety of languages.
 
 import re
 
+from copy import copy
+from hashlib import sha1
+from os.path import abspath
 from string import punctuation as PUNCTUATION
+from threading import local
 
 from docutils import nodes
 from docutils.frontend import OptionParser
@@ -160,20 +182,21 @@ from docutils.parsers.rst import directives, Directive, DirectiveError, Parser
 from docutils.parsers.rst.states import RSTStateMachine, state_classes
 from docutils.readers.standalone import Reader
 from docutils.transforms import writer_aux, universal, references, frontmatter
-from docutils.transforms import misc
+from docutils.transforms import misc, Transform
 from docutils.writers.html4css1 import HTMLTranslator, Writer as HTMLWriter
 from docutils.writers.latex2e import LaTeXTranslator, Writer as LaTexWriter
-from docutils.utils import new_document
+from docutils.utils import DependencyList, new_document
 
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import get_lexer_by_name, TextLexer
 
 try:
-    from simplejson import loads as decode_json
+    from simplejson import dumps as encode_json, loads as decode_json
 except ImportError:
-    from json import loads as decode_json
+    from json import dumps as encode_json, loads as decode_json
 
+from cache import CachingDict
 from io import IteratorParser
 
 # ------------------------------------------------------------------------------
@@ -281,11 +304,44 @@ break_directive.content = False
 directives.register_directive('break', break_directive)
 
 # ------------------------------------------------------------------------------
-# A Tag Directive!!
+# Render Context
 # ------------------------------------------------------------------------------
 
-SEEN_TAGS_CACHE = None
-TAG_COUNTER = None
+class RenderContext(object):
+    """The state shared by the tag and plan directives during a render."""
+
+    __slots__ = (
+        'plan_id', 'plan_items', 'plan_settings', 'plan_tags', 'seen_tags',
+        'tag_cache', 'tag_counter'
+        )
+
+    def __init__(self, tag_cache_size=1000):
+        self.plan_id = None
+        self.plan_items = []
+        self.plan_settings = {}
+        self.plan_tags = {}
+        self.seen_tags = set()
+        self.tag_cache = CachingDict(tag_cache_size)
+        self.tag_counter = 0
+
+    def get_plan_index(self):
+        """Return the index of the plan items and tags seen so far."""
+        return {'items': self.plan_items, 'tags': self.plan_tags}
+
+def get_render_context(document):
+    """Return the render context for the given ``document``."""
+
+    # The context lives on the document's settings, which are created afresh
+    # for each render, so that concurrent renders never share any state.
+    settings = document.settings
+    context = getattr(settings, 'render_context', None)
+    if context is None:
+        context = settings.render_context = RenderContext()
+    return context
+
+# ------------------------------------------------------------------------------
+# A Tag Directive!!
+# ------------------------------------------------------------------------------
 
 class TagDirective(Directive):
     """Convert tags into HTML annotation blocks."""
@@ -297,7 +353,7 @@ class TagDirective(Directive):
     has_content = True
 
     def run(
-        self, tag_cache={}, tag_normalised_cache={}, TODO=u'✗', DONE=u'✓',
+        self, TODO=u'✗', DONE=u'✓',
         letters='abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ -'
         ):
 
@@ -309,20 +365,20 @@ class TagDirective(Directive):
         else:
             arguments = []
 
-        tag_list_id = CURRENT_PLAN_ID or 'list'
+        context = get_render_context(self.state.document)
+        plan_id = context.plan_id
+        tag_cache = context.tag_cache
 
         output = []; add = output.append
         implicit_tags = {}
         tag_id = None
 
         def add_tag(
-            ori_tag, tag_span, cache=tag_normalised_cache, add=add,
-            implicit_tags=implicit_tags,
-            done_tags=CURRENT_PLAN_SETTINGS.get('done', []),
-            todo_tags=CURRENT_PLAN_SETTINGS.get('todo', []),
+            tag_span, norm_tag, tag_info, add=add, implicit_tags=implicit_tags,
+            done_tags=context.plan_settings.get('done', []),
+            todo_tags=context.plan_settings.get('todo', []),
             ):
-            add(tag_span)
-            norm_tag = cache[ori_tag]
+            add((tag_span, tag_info))
             if norm_tag in done_tags:
                 implicit_tags['done'] = True
             if norm_tag in todo_tags:
@@ -330,11 +386,12 @@ class TagDirective(Directive):
 
         for tag in arguments:
 
-            if tag in tag_cache:
-                add_tag(tag, tag_cache[tag])
+            # The rendering of ``dep:`` tags depends on the current plan.
+            cache_key = (plan_id, tag)
+            if cache_key in tag_cache:
+                add_tag(*tag_cache[cache_key])
                 continue
 
-            ori_tag = tag
             tag = tag.strip().rstrip(u',').strip()
 
             if not tag:
@@ -361,7 +418,7 @@ class TagDirective(Directive):
                     tag_text = u""
                 tag_type = tag_type.strip().lower()
                 if tag_type == 'dep' and ':' not in tag_text:
-                    tag_class = u'dep-%s-%s' % (CURRENT_PLAN_ID, tag_text)
+                    tag_class = u'dep-%s-%s' % (plan_id, tag_text)
                 else:
                     tag_class = u'-'.join(tag.replace(':', ' ').lower().split())
             else:
@@ -375,31 +432,48 @@ class TagDirective(Directive):
             else:
                 tag_name = tag_text
 
+            tag_info = (
+                u'tag tag-type-%s tag-val-%s' % (tag_type, tag_class),
+                tag_name, tag.lower()
+                )
+
             tag_span = (
-                u'<span class="tag tag-type-%s tag-val-%s" tagname="%s" '
-                 'tagnorm="%s">%s</span> ' %
-                (tag_type, tag_class, tag_name, tag.lower(), tag_text)
+                u'<span class="%s" tagname="%s" tagnorm="%s">%s</span> ' %
+                (tag_info + (tag_text,))
                 )
 
-            tag_cache[ori_tag] = tag_span
-            tag_normalised_cache[ori_tag] = tag_class
-            add_tag(ori_tag, tag_span)
+            tag_cache[cache_key] = (tag_span, tag_class, tag_info)
+            add_tag(tag_span, tag_class, tag_info)
 
         content = u'\n'.join(self.content)
         if content.startswith(TODO):
+            state = 'todo'
             if 'todo' not in implicit_tags:
-                add(
+                add((
                     u'<span class="tag tag-type-1 tag-val-todo" '
-                     'tagname="TODO" tagnorm="todo">TODO</span> '
-                    )
+                     'tagname="TODO" tagnorm="todo">TODO</span> ',
+                    (u'tag tag-type-1 tag-val-todo', u'TODO', u'todo')
+                    ))
         elif content.startswith(DONE):
+            state = 'done'
             if 'done' not in implicit_tags:
-                add(
+                add((
                     u'<span class="tag tag-type-1 tag-val-done" '
-                     'tagname="DONE" tagnorm="done">DONE</span> '
-                    )
+                     'tagname="DONE" tagnorm="done">DONE</span> ',
+                    (u'tag tag-type-1 tag-val-done', u'DONE', u'done')
+                    ))
+        else:
+            state = None
+
+        if 'done' in implicit_tags:
+            state = 'done'
+        elif 'todo' in implicit_tags and not state:
+            state = 'todo'
 
         output.sort()
+        tag_infos = [tag_info for _, tag_info in output]
+        output = [tag_span for tag_span, _ in output]
+        add = output.append
 
         if not tag_id:
             tag_id = '-'.join(''.join([
@@ -409,16 +483,15 @@ class TagDirective(Directive):
                 ]).split()).lower()
 
         if not tag_id:
-            global TAG_COUNTER
-            TAG_COUNTER = TAG_COUNTER + 1
-            tag_id = 'temp-%s' % TAG_COUNTER
+            context.tag_counter += 1
+            tag_id = 'temp-%s' % context.tag_counter
 
         tag_id = 'planitem-%s' % tag_id
 
-        if tag_id in SEEN_TAGS_CACHE:
+        if tag_id in context.seen_tags:
             raise DirectiveError(2, "The tag id %r has already been used!" % tag_id)
 
-        SEEN_TAGS_CACHE.add(tag_id)
+        context.seen_tags.add(tag_id)
 
         if not output:
             pass
@@ -440,6 +513,28 @@ class TagDirective(Directive):
             self.content, self.content_offset, tag_content_container
             )
 
+        # The index is added to after any nested items have been parsed so
+        # that its items are in the same order as their tag segments.
+        deps = []
+        tags = []
+        plan_tags = context.plan_tags
+        for klass, name, norm in tag_infos:
+            if 'tag-type-dep' in klass:
+                deps.append(klass.split(' ')[2][12:])
+                continue
+            key = u'-'.join(part for part in klass.split(' ') if part != 'tag')
+            tags.append(key)
+            if key not in plan_tags:
+                plan_tags[key] = {'name': name, 'norm': norm}
+
+        context.plan_items.append({
+            'deps': deps,
+            'id': tag_id,
+            'plan': plan_id,
+            'state': state,
+            'tags': tags
+            })
+
         prefix = nodes.raw(
             '', u'<div id="%s" class="tag-content">' % tag_id, format='html'
             )
@@ -453,17 +548,17 @@ directives.register_directive('tag', TagDirective)
 # Plan Directive!
 # ------------------------------------------------------------------------------
 
-CURRENT_PLAN_ID = None
-CURRENT_PLAN_SETTINGS = {}
-
 def plan_directive(name, arguments, options, content, lineno,
                    content_offset, block_text, state, state_machine):
     """Setup for tags relating to a plan file."""
 
-    global CURRENT_PLAN_ID
-    global CURRENT_PLAN_SETTINGS
+    context = get_render_context(state.document)
 
-    if not CURRENT_PLAN_ID:
+    if not context.plan_id:
+        # The index of the plan items is filled in once the whole document has
+        # been parsed, so that plan.js doesn't have to scrape it from the DOM.
+        index_node = nodes.pending(PlanIndex)
+        state.document.note_pending(index_node)
         raw_node = nodes.raw(
             '',
             '<div id="plan-container"></div>'
@@ -471,18 +566,40 @@ def plan_directive(name, arguments, options, content, lineno,
             '<hr class="clear" />',
             format='html'
             )
+        nodes_list = [index_node, raw_node]
     else:
-        raw_node = nodes.raw('', '', format='html')
+        nodes_list = [nodes.raw('', '', format='html')]
 
     content = '\n'.join(content)
     if content:
-        CURRENT_PLAN_SETTINGS = decode_json(content)
+        context.plan_settings = decode_json(content)
     else:
-        CURRENT_PLAN_SETTINGS = {}
+        context.plan_settings = {}
 
-    CURRENT_PLAN_ID = arguments[0]
+    context.plan_id = arguments[0]
 
-    return [raw_node]
+    return nodes_list
+
+class PlanIndex(Transform):
+    """Replace the pending plan index with the JSON index of the plan."""
+
+    default_priority = 880
+
+    def apply(self):
+        index = encode_json(
+            get_render_context(self.document).get_plan_index(),
+            separators=(',', ':'), sort_keys=True
+            )
+        # Escape the characters which would otherwise be mangled by the post
+        # processing of the output or which could close the script element.
+        index = index.replace('&', '\\u0026').replace(
+            '<', '\\u003c').replace('>', '\\u003e')
+        self.startnode.replace_self(nodes.raw(
+            '',
+            u'<script type="text/javascript">var PLAN_INDEX = %s;</script>'
+            % index,
+            format='html'
+            ))
 
 plan_directive.arguments = (1, 0, True)
 plan_directive.options = {}
@@ -543,89 +660,89 @@ def doctest2html(content):
 # Pretty Typographical Syntax Converter
 # ------------------------------------------------------------------------------
 
+TYPOGRAPHIC_ENTITIES = {
+    ' -->': ' -->',
+    '&quot;': '"',
+    '-&gt;': '&rarr;',
+    '<-': '&larr;',
+    '---': '&ndash;',
+    '--': '&mdash;',
+    '<<': '&laquo;',
+    '>>': '&raquo;',
+    '(C)': '&copy;', # hmz, why am i promoting ipr? ;p
+    '(c)': '&copy;',
+    '(tm)': '&trade;',
+    '(TM)': '&trade;',
+    '(r)': '&reg;',
+    '(R)': '&reg;',
+    '...': '&#8230;',
+    }
+
+QUOTE_ENTITIES = {
+    "'": ('&lsquo;', '&rsquo;'),
+    '"': ('&ldquo;', '&rdquo;'),
+    }
+
+# The alternatives are tried in order at each position, and the lookaheads
+# stop a match from taking a character which belongs to a match with a higher
+# priority that starts later on, e.g. the ``-`` of a ``-&gt;`` arrow.
+replace_typography = re.compile(
+    r' -->|&quot;|-&gt;|<-(?!&gt;)|---(?!&gt;)|--(?!&gt;)|<<(?!-(?!&gt;))|>>|'
+    r'\((?:C|c|tm|TM|r|R)\)|\.\.\.'
+    ).sub
+
+def compile_quote_matchers(flags=0):
+    followers = r'(?=[' + re.escape(PUNCTUATION) + r'\s]|\Z)'
+    return (
+        re.compile(r'(?:^|(?<=\s))[\'"]', flags).search,
+        dict((quote, re.compile(r'(?<!\\)' + quote + followers, flags).search)
+             for quote in QUOTE_ENTITIES)
+        )
+
+# The matchers for unicode text need to agree with ``unicode.isspace``.
+QUOTE_MATCHERS = compile_quote_matchers()
+UNICODE_QUOTE_MATCHERS = compile_quote_matchers(re.UNICODE)
+
+def get_typographic_entity(match, entities=TYPOGRAPHIC_ENTITIES):
+    return entities[match.group()]
+
 def convert(content):
     """Convert certain characters to prettier typographical syntax."""
 
-    # Remember: the order of the replacements matter...
-    content = content.replace(
-        '&quot;', '"').replace(
-        ' -->', 'HTML-COMMENT-ELEMENT-CLOSE').replace(
-        '-&gt;', '&rarr;').replace(
-        '<-', '&larr;').replace(
-        '---', '&ndash;').replace(
-        '--', '&mdash;').replace(
-        '<<', '&laquo;').replace(
-        '>>', '&raquo;').replace(
-        '(C)','&copy;').replace(    # hmz, why am i promoting ipr? ;p
-        '(c)','&copy;').replace(
-        '(tm)','&trade;').replace(
-        '(TM)','&trade;').replace(
-        '(r)','&reg;').replace(
-        '(R)','&reg;').replace(
-        '...', '&#8230;').replace(
-        'HTML-COMMENT-ELEMENT-CLOSE', ' -->')
-
-    icontent = IteratorParser(content)
-    content = []
-
-    _scurly = _dcurly = False
-    _space = True
-    _apply = False
-
-    index = 0
-    prev = ''
-
-    while True:
+    content = replace_typography(get_typographic_entity, content)
 
-        try:
-            char = icontent.next()
-        except StopIteration:
-            break
-
-        if not (_scurly or _dcurly) and _space:
-            if char == "'":
-                _scurly = index + 1
-            elif char == '"':
-                _dcurly = index + 1
-
-        if _scurly and (_scurly != index + 1) and char == "'" and prev != '\\':
-            try:
-                n = icontent.next()
-                if n in PUNCTUATION or n.isspace():
-                    _apply = True
-                icontent.push(n)
-            except:
-                _apply = True
-            if _apply:
-                content[_scurly - 1] = '&lsquo;'
-                char = '&rsquo;'
-                _scurly = False
-            _apply = False
-        
-        if _dcurly and (_dcurly != index + 1) and char == '"' and prev != '\\':
-            try:
-                n = icontent.next()
-                if n in PUNCTUATION or n.isspace():
-                    _apply = True
-                icontent.push(n)
-            except:
-                _apply = True
-            if _apply:
-                content[_dcurly - 1] = '&ldquo;'
-                char = '&rdquo;'
-                _dcurly = False
-            _apply = False
-
-        content.append(char)
-        prev = char
-        index += 1
-        
-        if char.isspace():
-            _space = True
+    # A quote which follows whitespace opens a pair of smart quotes. It is
+    # closed by the next quote of the same kind which isn't escaped and which
+    # is followed by punctuation, whitespace or the end of the text. Until it
+    # is closed, no other pair can be opened.
+    if "'" in content or '"' in content:
+        if isinstance(content, unicode):
+            find_opening, find_closing = UNICODE_QUOTE_MATCHERS
         else:
-            _space = False
+            find_opening, find_closing = QUOTE_MATCHERS
+        output = []; out = output.append
+        pos = 0
+        while True:
+            match = find_opening(content, pos)
+            if not match:
+                break
+            start = match.start()
+            quote = content[start]
+            match = find_closing[quote](content, start + 1)
+            if not match:
+                break
+            end = match.start()
+            opening, closing = QUOTE_ENTITIES[quote]
+            out(content[pos:start])
+            out(opening)
+            out(content[start+1:end])
+            out(closing)
+            pos = end + 1
+        if output:
+            out(content[pos:])
+            content = ''.join(output)
+        content = content.replace('"', '&quot;')
 
-    content = ''.join(content).replace('"', '&quot;')
     content = replace_plexlinks(render_plexlink, content)
 
     # perhaps === heading === stylee ?
@@ -791,162 +908,387 @@ def parse_headers(source_lines, props, toplevel=False):
 # Our Core Renderer
 # ------------------------------------------------------------------------------
 
-def render_rst(
-    source, format='xhtml', encoding='utf-8', with_props=False,
-    with_docinfo=False, as_whole=False
-    ):
-    """Return the rendered ``source`` with optional extracted properties."""
+LEAD_MARKER = u'<hr class="rst-lead-marker" />'
+LEAD_MARKER_LINES = [u'', u'.. raw:: html', u'', u'   ' + LEAD_MARKER, u'']
 
-    global SEEN_TAGS_CACHE, TAG_COUNTER, CURRENT_PLAN_ID
-    SEEN_TAGS_CACHE = set()
-    TAG_COUNTER = 0
-    CURRENT_PLAN_ID = None
-
-    if format in ('xhtml', 'html'):
-        format, translator, transforms, option_parser = HTML_SETUP
-    elif format in ('tex', 'latex'):
-        format, translator, transforms, option_parser = LATEX_SETUP
-    elif format == 'raw':
-        format, translator, transforms, option_parser = RAW_SETUP
-    else:
-        raise ValueError("Unknown format: %r" % format)
+RENDER_SETTINGS = {
+    'footnote_references': 'superscript', # 'mixed', 'brackets'
+    'halt_level': 6,
+    'trim_footnote_reference_space': 1,
+    }
 
-    settings = option_parser.get_default_values()
-    settings._update_loose({
-        'footnote_references': 'superscript', # 'mixed', 'brackets'
-        'halt_level': 6,
-        'trim_footnote_reference_space': 1,
-        })
+def get_files_digest(paths):
+    """Return the digest of the content of the files at the given ``paths``."""
 
-    document = new_document('[dynamic-text]', settings)
+    digest = sha1()
+    for path in paths:
+        digest.update(repr(path))
+        try:
+            file_obj = open(path, 'rb')
+        except IOError:
+            digest.update('\0')
+            continue
+        digest.update(sha1(file_obj.read()).digest())
+        file_obj.close()
+    return digest.digest()
 
-    if not isinstance(source, unicode):
-        source = unicode(source, encoding)
+def get_source_lines(source):
+    """Return the normalised lines of the given ``source``."""
 
     source = replace_whitespace(' ', source)
-    source_lines = [s.expandtabs(4).rstrip() for s in source.splitlines()]
+    return [line.expandtabs(4).rstrip() for line in source.splitlines()]
+
+class Renderer(object):
+    """
+    A reusable reST renderer which memoises its output.
+
+    The docutils settings are only created once per output format and the
+    state machine is reused between renders. Rendered output is memoised under
+    the digest of the source and the render options, so unchanged content is
+    returned without running docutils again. Any files pulled in by directives
+    like ``include`` are recorded and their content is checked before a
+    memoised result is reused.
+
+    A renderer keeps state between renders and so shouldn't be shared between
+    threads -- ``render_rst`` uses a separate renderer for each thread.
+
+    """
+
+    def __init__(self, cache_size=1000):
+        self.cache = CachingDict(cache_size)
+        self.settings = {}
+        self.state_machine = None
+
+    def get_settings(self, format, option_parser):
+        settings = self.settings.get(format)
+        if settings is None:
+            settings = option_parser.get_default_values()
+            settings._update_loose(RENDER_SETTINGS)
+            self.settings[format] = settings
+        # Take a shallow copy so that changes made during a render don't leak.
+        settings = copy(settings)
+        settings.record_dependencies = DependencyList()
+        settings.render_context = RenderContext()
+        return settings
+
+    def render(
+        self, source, format='xhtml', encoding='utf-8', with_props=False,
+        with_docinfo=False, as_whole=False
+        ):
+        """Return the rendered ``source`` with optional extracted properties."""
 
-    if with_props:
-        source_lines, props = parse_headers(source_lines, {}, True)
+        if not isinstance(source, unicode):
+            source = unicode(source, encoding)
 
-    document.reporter.attach_observer(document.note_parse_message)
+        key = (
+            sha1(source.encode('utf-8')).digest(), format, bool(with_props),
+            bool(with_docinfo), bool(as_whole)
+            )
 
-    RSTStateMachine(
-        state_classes=state_classes,
-        initial_state='Body',
-        ).run(source_lines, document)
+        entry = self.cache.get(key)
+        if entry is None or get_files_digest(entry[1]) != entry[2]:
+            result, deps, _ = self.process(
+                source, format, with_props, with_docinfo, as_whole
+                )
+            entry = self.cache[key] = (result, deps, get_files_digest(deps))
 
-    document.reporter.detach_observer(document.note_parse_message)
-    document.current_source = document.current_line = None
+        result = entry[0]
+        if with_props:
+            return result[0], result[1].copy()
 
-    document.transformer.add_transforms(transforms)
-    document.transformer.apply_transforms()
+        return result
 
-    if not format:
-        return unicode(document)
+    def render_with_lead(self, source, lead, encoding='utf-8', **kwargs):
+        """
+        Return the rendered ``source`` along with a rendering of its ``lead``.
 
-    visitor = translator(document)
-    document.walkabout(visitor)
+        The ``lead`` needs to be a prefix of the ``source``. Where it ends on a
+        blank line at the top level of the document, it is cut out of the full
+        render instead of being rendered separately.
 
-    # see HTML_VISITOR_ATTRIBUTES/LATEX_VISITOR_ATTRIBUTES to see other attrs
+        """
 
-    if as_whole:
-        output = visitor.astext()
-    else:
-        if format == 'html' and with_docinfo:
-            output = (
-                u'<div class="docinfo">\n%s\n</div>\n<div class="document">\n%s</div>'
-                % (u''.join(visitor.docinfo), u''.join(visitor.body))
+        if not isinstance(source, unicode):
+            source = unicode(source, encoding)
+        if not isinstance(lead, unicode):
+            lead = unicode(lead, encoding)
+
+        if not source.startswith(lead):
+            raise ValueError("The lead is not a prefix of the source.")
+
+        format = kwargs.get('format', 'xhtml')
+        with_props = kwargs.get('with_props', False)
+        rest = source[len(lead):]
+
+        if not (
+            format in ('xhtml', 'html') and lead.strip() and
+            lead.endswith(u'\n') and rest.startswith(u'\n') and
+            not rest.lstrip(u'\n')[:1].isspace() and rest.strip() and
+            not kwargs.get('with_docinfo') and not kwargs.get('as_whole')
+            ):
+            return (
+                self.render(source, **kwargs),
+                self.render(lead, format=format)
+                )
+
+        key = (
+            sha1(source.encode('utf-8')).digest(), len(lead), format,
+            bool(with_props)
+            )
+
+        entry = self.cache.get(key)
+        if entry is None or get_files_digest(entry[1]) != entry[2]:
+            result, deps, lead_output = self.process(
+                source, format, with_props, lead=lead
                 )
+            entry = (result, lead_output), deps, get_files_digest(deps)
+            self.cache[key] = entry
+
+        result, lead_output = entry[0]
+        if lead_output is None:
+            lead_output = self.render(lead, format=format)
+        if with_props:
+            result = result[0], result[1].copy()
+
+        return result, lead_output
+
+    def process(
+        self, source, format='xhtml', with_props=False, with_docinfo=False,
+        as_whole=False, lead=None
+        ):
+        """
+        Render the unicode ``source`` and return it with its dependencies.
+
+        If a ``lead`` is given, a marker is placed where it ends and is used to
+        cut the rendered lead out of the output. The marker is taken out of the
+        doctree while the transforms are applied, and the plain render is done
+        instead if the marker could have had any effect on the output.
+
+        """
+
+        if format in ('xhtml', 'html'):
+            format, translator, transforms, option_parser = HTML_SETUP
+        elif format in ('tex', 'latex'):
+            format, translator, transforms, option_parser = LATEX_SETUP
+        elif format == 'raw':
+            format, translator, transforms, option_parser = RAW_SETUP
         else:
-            output = u''.join(visitor.body)
-
-    # Post RST-Conversion Prosessing
-    if format == 'html':
-
-        # [[plexlinks]]
-        # output = re.sub(
-        #     '(?sm)\[\[(.*?)\]\]',
-        #     render_plexlink,
-        #     output)
-
-        # syntax highlighting for kode snippets
-        # output = re.sub(
-        #     '(?sm)<p>(?:\s)?&lt;code class=&quot;(.*?)&quot;&gt;(?::)?</p>(?:\n<blockquote>)?\n<pre class="literal-block">(.*?)</pre>(?:\n</blockquote>)?\n<p>(?:\s)?&lt;/code&gt;</p>',
-        #     code2html,
-        #     output)
-
-        # Support for embedding html into RST documents and prettification.
-        output = escape_and_prettify(output)
-
-        # TOC href ID and div adder.
-        output = replace_toc_attributes(
-            '<p class="topic-title\\1"><a name="\\2"></a><span '
-            'id="document-toc">\\3</span></p>\n<div id="documen'
-            't-toc-listing">\\4</div></div>',
-            output)
-
-        # Inserting an "#abstract" ID.
-        output = replace_abstract_attributes(
-            r'<div id="abstract" class="abstract topic">',
-            output)
-
-        # footnote refs looking a bit too superskripted
-        # output = re.sub(
-        #     '(?sm)<a class="footnote-reference" (.*?)><sup>(.*?)</sup></a>',
-        #     r'<a class="footnote-reference" \1>\2</a>',
-        #     output)
-
-        # Drop shadow wrappers for figures.
-        output = replace_drop_shadows(
-            '<div class="figure\\1<div class="wrap1"><div class="wrap2">'
-            '<div class="wrap3"><img\\2/></div></div></div>\\3</div>',
-            output)
-
-        # @/@ reinstate this? -- name="" no no
-        # output = re.sub(r'<a name="table-of-contents"></a>', '', output)
-        # output = re.sub(r'<a (.*?) name="(.*?)">', r'<a \1>', output)
-
-        # get rid of <p>around floating images</p>
-        # output = re.sub(
-        #     '(?sm)<p><img (.*?) class="float-(.*?) /></p>',
-        #     r'<img \1 class="float-\2 />',
-        #     output)
-
-        # niser <hr />
-        # output = re.sub(
-        #     '<hr />',
-        #    r'<hr noshade="noshade" />',
-        #    output)
-
-        # drop cap them first letters
-        # output = re.sub(
-        #     '(?sm)<p>(.*?)</p>',
-        #     render_drop_cap,
-        #     output, count=1)
-
-        # Strip out comments.
-        output = replace_comments('', output)
-
-        # Strip out title headings.
-        output = replace_title_headings('', output)
-
-        # Strip out border="1".
-        output = replace_table_borders(r'<table class="docutils">', output)
-
-        # Pad out tick/cross marks.
-        output = output.replace(u'<p>✓ ', u'<p>✓ &nbsp; ')
-        output = output.replace(u'<p>✗ ', u'<p>✗ &nbsp; ')
-
-    if with_props:
-        if format == 'html':
-            props.setdefault(u'title', visitor.title and visitor.title[0] or u'')
-            props.setdefault(
-                u'subtitle', visitor.subtitle and visitor.subtitle[0] or u''
+            raise ValueError("Unknown format: %r" % format)
+
+        settings = self.get_settings(format, option_parser)
+        document = new_document('[dynamic-text]', settings)
+
+        if lead is None:
+            source_lines = get_source_lines(source)
+            if with_props:
+                source_lines, props = parse_headers(source_lines, {}, True)
+        else:
+            source_lines = get_source_lines(lead)
+            rest_lines = get_source_lines(source[len(lead):])
+            if with_props:
+                source_lines, props = parse_headers(source_lines, {}, True)
+                rest_lines, props = parse_headers(rest_lines, props, True)
+            source_lines.extend(LEAD_MARKER_LINES)
+            source_lines.extend(rest_lines)
+
+        document.reporter.attach_observer(document.note_parse_message)
+
+        state_machine = self.state_machine
+        if state_machine is None:
+            state_machine = self.state_machine = RSTStateMachine(
+                state_classes=state_classes,
+                initial_state='Body',
                 )
-        return output, props
 
-    return output
+        try:
+            state_machine.run(source_lines, document)
+        except:
+            # Don't reuse a state machine which may be left in a bad state.
+            self.state_machine = None
+            raise
+
+        document.reporter.detach_observer(document.note_parse_message)
+        document.current_source = document.current_line = None
+
+        if lead is not None:
+            marker = prev = None
+            for node in document.traverse(nodes.raw):
+                if node.astext() == LEAD_MARKER:
+                    marker = node
+                    break
+            if marker is None:
+                return self.process(
+                    source, format, with_props, with_docinfo, as_whole
+                    )
+            parent = marker.parent
+            idx = parent.index(marker)
+            if idx:
+                prev = parent[idx-1]
+            parent.remove(marker)
+            # Without the marker, two lists of the same kind would have been
+            # parsed as one.
+            if prev is not None and idx < len(parent):
+                following = parent[idx]
+                if prev.__class__ is following.__class__ and isinstance(
+                    prev, (nodes.Sequential, nodes.block_quote)
+                    ):
+                    return self.process(
+                        source, format, with_props, with_docinfo, as_whole
+                        )
+
+        document.transformer.add_transforms(transforms)
+        document.transformer.apply_transforms()
+
+        if lead is not None:
+            # The line numbers in any system messages would be off.
+            if document.traverse(nodes.system_message):
+                return self.process(
+                    source, format, with_props, with_docinfo, as_whole
+                    )
+            # The marker can only be used to cut the output at the top level
+            # of the document, as otherwise the cut would leave open elements.
+            for idx, node in enumerate(document.children):
+                if node is prev:
+                    document.insert(idx + 1, marker)
+                    break
+
+        deps = [abspath(path) for path in settings.record_dependencies.list]
+
+        if not format:
+            return unicode(document), deps, None
+
+        visitor = translator(document)
+        document.walkabout(visitor)
+
+        # see HTML_VISITOR_ATTRIBUTES/LATEX_VISITOR_ATTRIBUTES to see other attrs
+
+        if as_whole:
+            output = visitor.astext()
+        else:
+            if format == 'html' and with_docinfo:
+                output = (
+                    u'<div class="docinfo">\n%s\n</div>\n<div class="document">\n%s</div>'
+                    % (u''.join(visitor.docinfo), u''.join(visitor.body))
+                    )
+            else:
+                output = u''.join(visitor.body)
+
+        # Post RST-Conversion Prosessing
+        if format == 'html':
+
+            # [[plexlinks]]
+            # output = re.sub(
+            #     '(?sm)\[\[(.*?)\]\]',
+            #     render_plexlink,
+            #     output)
+
+            # syntax highlighting for kode snippets
+            # output = re.sub(
+            #     '(?sm)<p>(?:\s)?&lt;code class=&quot;(.*?)&quot;&gt;(?::)?</p>(?:\n<blockquote>)?\n<pre class="literal-block">(.*?)</pre>(?:\n</blockquote>)?\n<p>(?:\s)?&lt;/code&gt;</p>',
+            #     code2html,
+            #     output)
+
+            # Support for embedding html into RST documents and prettification.
+            output = escape_and_prettify(output)
+
+            # TOC href ID and div adder.
+            output = replace_toc_attributes(
+                '<p class="topic-title\\1"><a name="\\2"></a><span '
+                'id="document-toc">\\3</span></p>\n<div id="documen'
+                't-toc-listing">\\4</div></div>',
+                output)
+
+            # Inserting an "#abstract" ID.
+            output = replace_abstract_attributes(
+                r'<div id="abstract" class="abstract topic">',
+                output)
+
+            # footnote refs looking a bit too superskripted
+            # output = re.sub(
+            #     '(?sm)<a class="footnote-reference" (.*?)><sup>(.*?)</sup></a>',
+            #     r'<a class="footnote-reference" \1>\2</a>',
+            #     output)
+
+            # Drop shadow wrappers for figures.
+            output = replace_drop_shadows(
+                '<div class="figure\\1<div class="wrap1"><div class="wrap2">'
+                '<div class="wrap3"><img\\2/></div></div></div>\\3</div>',
+                output)
+
+            # @/@ reinstate this? -- name="" no no
+            # output = re.sub(r'<a name="table-of-contents"></a>', '', output)
+            # output = re.sub(r'<a (.*?) name="(.*?)">', r'<a \1>', output)
+
+            # get rid of <p>around floating images</p>
+            # output = re.sub(
+            #     '(?sm)<p><img (.*?) class="float-(.*?) /></p>',
+            #     r'<img \1 class="float-\2 />',
+            #     output)
+
+            # niser <hr />
+            # output = re.sub(
+            #     '<hr />',
+            #    r'<hr noshade="noshade" />',
+            #    output)
+
+            # drop cap them first letters
+            # output = re.sub(
+            #     '(?sm)<p>(.*?)</p>',
+            #     render_drop_cap,
+            #     output, count=1)
+
+            # Strip out comments.
+            output = replace_comments('', output)
+
+            # Strip out title headings.
+            output = replace_title_headings('', output)
+
+            # Strip out border="1".
+            output = replace_table_borders(r'<table class="docutils">', output)
+
+            # Pad out tick/cross marks.
+            output = output.replace(u'<p>✓ ', u'<p>✓ &nbsp; ')
+            output = output.replace(u'<p>✗ ', u'<p>✗ &nbsp; ')
+
+        lead_output = None
+        if lead is not None:
+            idx = output.find(LEAD_MARKER)
+            if idx != -1:
+                lead_output = output[:idx].strip()
+                output = output[:idx] + output[idx+len(LEAD_MARKER):]
+
+        if with_props:
+            if format == 'html':
+                props.setdefault(
+                    u'title', visitor.title and visitor.title[0] or u''
+                    )
+                props.setdefault(
+                    u'subtitle', visitor.subtitle and visitor.subtitle[0] or u''
+                    )
+            return (output, props), deps, lead_output
+
+        return output, deps, lead_output
+
+RENDERERS = local()
+
+def get_renderer():
+    """Return the renderer for the current thread."""
+
+    try:
+        return RENDERERS.renderer
+    except AttributeError:
+        renderer = RENDERERS.renderer = Renderer()
+        return renderer
+
+def render_rst(
+    source, format='xhtml', encoding='utf-8', with_props=False,
+    with_docinfo=False, as_whole=False
+    ):
+    """Return the rendered ``source`` with optional extracted properties."""
+
+    return get_renderer().render(
+        source, format, encoding, with_props, with_docinfo, as_whole
+        )
 
     # You can do the above by using ``docutils.core`` -- pub = Publisher() --
     # but it's a pretty inefficient way of going about converting to HTML/LaTeX.
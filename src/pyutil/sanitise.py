@@ -33,22 +33,67 @@ from a wide range of XSS attacks:
   >>> sanitise('<SCRIPT/SRC="http://ha.ckers.org/xss.js"></SCRIPT>')
   'SRC="http:/ha.ckers.org/xss.js">'
 
+  >>> sanitise('<!DOCTYPE html SYSTEM "><script>alert(1)</script>">')
+  '<!DOCTYPE html SYSTEM "&gt;&lt;script&gt;alert(1)&lt;/script&gt;">'
+
+  >>> sanitise('<!DOCTYPE html PUBLIC "a><img src=x onerror=alert(1)>">')
+  '<!DOCTYPE html PUBLIC "a&gt;&lt;img src=x onerror=alert(1)&gt;">'
+
+The whitelists can be given as any container, including lists:
+
+  >>> sanitise('<p style="color: red; width: 10px">hi</p>',
+  ...          valid_css_properties=['color'])
+  '<p style="color:  red;">hi</p>'
+
+Content which is rendered repeatedly can be sanitised through a cache, which is
+keyed by both the input and the whitelists in use:
+
+  >>> cached_sanitise = SanitiseCache(rel_whitelist=['nofollow'])
+  >>> cached_sanitise('<a href="http://tav.espians.com" rel="me">tav</a>')
+  '<a href="http://tav.espians.com">tav</a>'
+
+  >>> len(cached_sanitise.local)
+  1
+
+And large batches of documents can be sanitised in parallel, with the results
+being yielded in the same order as the input:
+
+  >>> docs = ['<b>1</b>', '<i onclick="alert(1)">2</i>', '<script>3</script>']
+  >>> list(sanitise_many(docs, workers=2, chunk_size=2))
+  ['<b>1</b>', '<i>2</i>', '3']
+
 """ # emacs "'
 
 # See http://ha.ckers.org/xss.html for a listing of various XSS attacks
 
 import re
 
-from BeautifulSoup import BeautifulSoup, CData, Comment, ProcessingInstruction
+from collections import deque
+from hashlib import sha1
+from itertools import islice
+from time import time
+from sgmllib import SGMLParseError, SGMLParser
+
+from pyutil.cache import CachingDict
 
 # ------------------------------------------------------------------------------
 # Utility Functions
 # ------------------------------------------------------------------------------
 
 create_set = lambda values: frozenset(values.strip().split())
-find_cdata = lambda text: isinstance(text, CData)
-find_comments = lambda text: isinstance(text, Comment)
-find_pi = lambda text: isinstance(text, ProcessingInstruction)
+
+escape_bare_ampersands = re.compile(
+    '&(?!#[0-9]+;|#x[0-9a-fA-F]+;|[a-zA-Z][a-zA-Z0-9]*;)'
+    ).sub
+
+escape_attr_value = lambda value: escape_bare_ampersands(
+    '&amp;', value).replace('<', '&lt;').replace('>', '&gt;').replace(
+    '"', '&quot;')
+
+massage_markup = (
+    (re.compile('(<[^<>]*)/>').sub, r'\1 />'),
+    (re.compile('<!\s+([^<>]*)>').sub, r'<!\1>')
+    )
 
 match_js_in_uri_ref = re.compile(
     '(%s)*'
@@ -254,119 +299,186 @@ VALID_CSS_KEYWORDS = create_set("""
 
 VALID_CSS_CLASSES = frozenset()
 
+# The content of quote tags is treated as literal text until the matching end
+# tag, and void tags are always rendered as self-closing.
+
+QUOTE_TAGS = frozenset(['script', 'textarea'])
+
+VOID_TAGS = create_set("""
+    area base br col command embed frame hr img input keygen link meta param
+    source spacer track wbr
+    """)
+
 # ------------------------------------------------------------------------------
-# Core Function
+# Style Attributes
 # ------------------------------------------------------------------------------
 
-def sanitise(
-    html, valid_tags=VALID_TAGS, valid_attrs=VALID_ATTRS,
-    valid_attr_prefixes=VALID_ATTR_PREFIXES,
-    attrs_with_uri_refs=ATTRS_WITH_URI_REFS,
-    valid_css_properties=VALID_CSS_PROPERTIES,
-    valid_css_keywords=VALID_CSS_KEYWORDS,
-    valid_css_classes=VALID_CSS_CLASSES,
-    secure_id_prefix='local-', strip_cdata=True, strip_comments=True,
-    strip_pi=True, rel_whitelist=None, second_run=False
-    ):
-    """Return a sanitised version of the provided HTML."""
+# A CSS value is split into components of either quoted strings or runs of
+# non-whitespace characters. The unicode variant is needed so that whitespace
+# matches what unicode.isspace() considers to be whitespace.
 
-    soup = BeautifulSoup(html)
+CSS_COMPONENT_PATTERN = r'["\']([^"\']*)(["\']|\Z)|([^\s"\'][^\s]*)'
 
-    if strip_cdata:
-        for cdata in soup.findAll(text=find_cdata):
-            cdata.extract()
+find_css_components = re.compile(CSS_COMPONENT_PATTERN).findall
+find_unicode_css_components = re.compile(CSS_COMPONENT_PATTERN, re.U).findall
 
-    if strip_comments:
-        for comment in soup.findAll(text=find_comments):
-            comment.extract()
+STYLE_CACHE = CachingDict(1000)
 
-    if strip_pi:
-        for pi in soup.findAll(text=find_pi):
-            pi.extract()
+def sanitise_style(
+    style, valid_css_properties=VALID_CSS_PROPERTIES,
+    valid_css_keywords=VALID_CSS_KEYWORDS, cache=STYLE_CACHE
+    ):
+    """Return the whitelisted declarations of the given ``style`` value."""
+
+    # Whitelists given as lists or sets can't be hashed, so results for them
+    # simply aren't memoised.
+    key = (style, valid_css_properties, valid_css_keywords)
+    try:
+        if key in cache:
+            return cache[key]
+    except TypeError:
+        key = None
+
+    if isinstance(style, unicode):
+        find_components = find_unicode_css_components
+    else:
+        find_components = find_css_components
+
+    new_style = []; add_style = new_style.append
+    for declaration in style.split(';'):
+        declaration = declaration.strip().split(':', 1)
+        if len(declaration) != 2:
+            continue
+        prop, value = declaration
+        prop = prop.strip().lower()
+        if prop not in valid_css_properties:
+            continue
+        new_value = []; add_part = new_value.append
+        segments = filter(None, value.split(','))
+        segcount = len(segments) - 1
+        valid = True
+        for idx, segment in enumerate(segments):
+            for quoted, closed, component in find_components(segment):
+                if not component:
+                    if not (closed or quoted):
+                        continue
+                    component = quoted
+                norm = '-'.join(component.lower().split())
+                if norm not in valid_css_keywords:
+                    if not match_valid_css_value(norm):
+                        valid = False
+                        break
+                if ' ' in component:
+                    add_part(' "%s"' % component)
+                else:
+                    add_part(' %s' % component)
+            if not valid:
+                break
+            if idx != segcount:
+                add_part(', ')
+        if not valid:
+            continue
+        add_style("%s: %s;" % (prop, ''.join(new_value)))
 
-    for tag in soup.findAll(True):
+    new_style = ''.join(new_style)
+    if key is not None:
+        cache[key] = new_style
 
-        if tag.name not in valid_tags:
-            tag.hidden = True
-            continue
+    return new_style
 
-        tag_attrs = []; append = tag_attrs.append
+# ------------------------------------------------------------------------------
+# Streaming Sanitiser
+# ------------------------------------------------------------------------------
 
-        for attr, val in tag.attrs:
+class Sanitiser(SGMLParser, object):
+    """
+    A streaming sanitiser which filters HTML as it is being tokenised.
+
+    Start tags are checked against the whitelists as soon as they are seen and
+    only the valid tags are written to the ``output`` list. Invalid tags are
+    dropped, but their content is kept, and a stack of the open tags is used to
+    balance the end tags so that the output is always well-formed.
+
+    """
+
+    def __init__(
+        self, valid_tags=VALID_TAGS, valid_attrs=VALID_ATTRS,
+        valid_attr_prefixes=VALID_ATTR_PREFIXES,
+        attrs_with_uri_refs=ATTRS_WITH_URI_REFS,
+        valid_css_properties=VALID_CSS_PROPERTIES,
+        valid_css_keywords=VALID_CSS_KEYWORDS,
+        valid_css_classes=VALID_CSS_CLASSES,
+        secure_id_prefix='local-', strip_cdata=True, strip_comments=True,
+        strip_pi=True, rel_whitelist=None, escape_lt=False
+        ):
+        self.valid_tags = valid_tags
+        self.valid_attrs = valid_attrs
+        self.valid_attr_prefixes = valid_attr_prefixes
+        self.attrs_with_uri_refs = attrs_with_uri_refs
+        self.valid_css_properties = valid_css_properties
+        self.valid_css_keywords = valid_css_keywords
+        self.valid_css_classes = valid_css_classes
+        self.secure_id_prefix = secure_id_prefix
+        self.strip_cdata = strip_cdata
+        self.strip_comments = strip_comments
+        self.strip_pi = strip_pi
+        self.rel_whitelist = rel_whitelist
+        self.escape_lt = escape_lt
+        SGMLParser.__init__(self)
+
+    def reset(self):
+        SGMLParser.reset(self)
+        self.output = []
+        self.open_tags = []
+        self.quote_tags = []
+        self.has_raw_lt = False
+
+    # Stay in literal mode for as long as we are inside a quote tag -- the base
+    # parser would otherwise leave it after any end tag, e.g. </b> in a script.
+    literal = property(
+        lambda self: bool(self.quote_tags), lambda self, value: None
+        )
+
+    def feed(self, data):
+        for massage, replacement in massage_markup:
+            data = massage(replacement, data)
+        SGMLParser.feed(self, data)
+
+    def close(self):
+        # Incomplete markup at the end of the input is dropped rather than being
+        # emitted as text.
+        if self.rawdata[:1] != '<':
+            SGMLParser.close(self)
+        self.rawdata = ''
+        out = self.output.append
+        for tag, visible in reversed(self.open_tags):
+            if visible:
+                out('</%s>' % tag)
+        self.open_tags = []
+
+    def sanitise_attrs(self, attrs):
+        tag_attrs = []; append = tag_attrs.append
+        valid_attrs = self.valid_attrs
+        attrs_with_uri_refs = self.attrs_with_uri_refs
+        rel_whitelist = self.rel_whitelist
+        for attr, val in attrs:
             if attr not in valid_attrs:
-                for prefix in valid_attr_prefixes:
+                for prefix in self.valid_attr_prefixes:
                     if attr.startswith(prefix):
                         append((attr, val))
                         break
                 continue
             if attr == 'id':
-                if not val.startswith(secure_id_prefix):
+                if not val.startswith(self.secure_id_prefix):
                     continue
             elif attr == 'style':
-                new_style = []; add_style = new_style.append
-                for style in val.split(';'):
-                    style = style.strip().split(':', 1)
-                    if len(style) != 2:
-                        continue
-                    prop, value = style
-                    prop = prop.strip().lower()
-                    if prop not in valid_css_properties:
-                        continue
-                    components = []; add_component = components.append
-                    segments = filter(None, value.split(','))
-                    segcount = len(segments) - 1
-                    for idx, segment in enumerate(segments):
-                        current = None
-                        in_quotes = 0
-                        for char in segment:
-                            if current is None:
-                                if char.isspace():
-                                    continue
-                                if char == '"' or char == "'":
-                                    in_quotes = 1
-                                    current = ''
-                                else:
-                                    current = char
-                                continue
-                            if in_quotes:
-                                if char == '"' or char == "'":
-                                    in_quotes = 0
-                                    add_component(current)
-                                    current = None
-                                else:
-                                    current += char
-                            else:
-                                if char.isspace():
-                                    add_component(current)
-                                    current = None
-                                else:
-                                    current += char
-                        if current:
-                            add_component(current)
-                        if idx != segcount:
-                            add_component(',')
-                    valid = True
-                    new_value = []; add_part = new_value.append
-                    for component in components:
-                        if component == ',':
-                            add_part(', ')
-                            continue
-                        norm = '-'.join(component.lower().split())
-                        if norm not in valid_css_keywords:
-                            if not match_valid_css_value(norm):
-                                valid = False
-                                break
-                        if ' ' in component:
-                            add_part(' "%s"' % component)
-                        else:
-                            add_part(' %s' % component)
-                    if not valid:
-                        continue
-                    add_style("%s: %s;" % (prop, ''.join(new_value)))
-                if not new_style:
+                val = sanitise_style(
+                    val, self.valid_css_properties, self.valid_css_keywords
+                    )
+                if not val:
                     continue
-                val = ''.join(new_style)
             elif attr == 'class':
+                valid_css_classes = self.valid_css_classes
                 val = ' '.join(
                     klass for klass in val.split()
                     if klass in valid_css_classes
@@ -382,20 +494,354 @@ def sanitise(
                 if val.split(':')[0] not in rel_whitelist:
                     continue
             append((attr, val))
+        return tag_attrs
+
+    def unknown_starttag(self, tag, attrs):
+        if tag in QUOTE_TAGS:
+            self.quote_tags.append(tag)
+        visible = tag in self.valid_tags
+        if visible:
+            markup = ['<', tag]; out = markup.append
+            for attr, val in self.sanitise_attrs(attrs):
+                out(' %s="%s"' % (attr, escape_attr_value(val)))
+            if tag in VOID_TAGS:
+                out(' />')
+            else:
+                out('>')
+            self.output.append(''.join(markup))
+        if tag not in VOID_TAGS:
+            self.open_tags.append((tag, visible))
+
+    def unknown_endtag(self, tag):
+        quote_tags = self.quote_tags
+        if quote_tags:
+            if quote_tags[-1] != tag:
+                self.handle_data('</%s>' % tag)
+                return
+            quote_tags.pop()
+        open_tags = self.open_tags
+        for idx in xrange(len(open_tags) - 1, -1, -1):
+            if open_tags[idx][0] == tag:
+                break
+        else:
+            return
+        out = self.output.append
+        for tag, visible in reversed(open_tags[idx:]):
+            if visible:
+                out('</%s>' % tag)
+        del open_tags[idx:]
+
+    def handle_data(self, data):
+        if '<' in data:
+            if self.escape_lt:
+                data = data.replace('<', '&lt;')
+            else:
+                self.has_raw_lt = True
+        self.output.append(data)
+
+    def handle_charref(self, ref):
+        self.output.append('&#%s;' % ref)
+
+    def handle_entityref(self, ref):
+        self.output.append('&%s;' % ref)
+
+    def handle_comment(self, data):
+        if not self.strip_comments:
+            self.output.append('<!--%s-->' % data)
+
+    def handle_decl(self, data):
+        # A browser ends the declaration at the first '>', so any markup which
+        # the parser saw as being quoted within it has to be escaped.
+        self.output.append('<!%s>' % escape_bare_ampersands(
+            '&amp;', data).replace('<', '&lt;').replace('>', '&gt;'))
+
+    def handle_pi(self, data):
+        if not self.strip_pi:
+            self.output.append('<?%s>' % data)
+
+    def parse_declaration(self, i):
+        rawdata = self.rawdata
+        if rawdata.startswith('<![CDATA[', i):
+            j = rawdata.find(']]>', i)
+            if j == -1:
+                j = len(rawdata)
+            if not self.strip_cdata:
+                self.output.append('<![CDATA[%s]]>' % rawdata[i+9:j])
+            return j + 3
+        try:
+            return SGMLParser.parse_declaration(self, i)
+        except SGMLParseError:
+            self.handle_data(rawdata[i:])
+            return len(rawdata)
+
+# ------------------------------------------------------------------------------
+# Core Function
+# ------------------------------------------------------------------------------
+
+def sanitise(
+    html, valid_tags=VALID_TAGS, valid_attrs=VALID_ATTRS,
+    valid_attr_prefixes=VALID_ATTR_PREFIXES,
+    attrs_with_uri_refs=ATTRS_WITH_URI_REFS,
+    valid_css_properties=VALID_CSS_PROPERTIES,
+    valid_css_keywords=VALID_CSS_KEYWORDS,
+    valid_css_classes=VALID_CSS_CLASSES,
+    secure_id_prefix='local-', strip_cdata=True, strip_comments=True,
+    strip_pi=True, rel_whitelist=None, second_run=False
+    ):
+    """Return a sanitised version of the provided HTML."""
+
+    sanitiser = Sanitiser(
+        valid_tags, valid_attrs, valid_attr_prefixes, attrs_with_uri_refs,
+        valid_css_properties, valid_css_keywords, valid_css_classes,
+        secure_id_prefix, strip_cdata, strip_comments, strip_pi, rel_whitelist,
+        second_run
+        )
+
+    sanitiser.feed(html)
+    sanitiser.close()
 
-        tag.attrs = tag_attrs
+    output = ''.join(sanitiser.output)
+    if isinstance(output, unicode):
+        output = output.encode('utf-8')
 
     # protects against: <<SCRIPT>script>("XSS");//<</SCRIPT>
+    #
+    # Markup can only be formed out of text which contained a raw '<', so the
+    # output only needs to be tokenised again when that has happened.
 
-    if not second_run:
+    if sanitiser.has_raw_lt:
         return sanitise(
-            soup.renderContents(), valid_tags, valid_attrs, valid_attr_prefixes,
+            output, valid_tags, valid_attrs, valid_attr_prefixes,
             attrs_with_uri_refs, valid_css_properties, valid_css_keywords,
             valid_css_classes, secure_id_prefix, strip_cdata, strip_comments,
             strip_pi, rel_whitelist, True
             )
 
-    return soup.renderContents()
+    return output
+
+# ------------------------------------------------------------------------------
+# Sanitisation Cache
+# ------------------------------------------------------------------------------
+
+SANITISE_PARAMS = sanitise.func_code.co_varnames[
+    1:sanitise.func_code.co_argcount - 1
+    ]
+SANITISE_DEFAULTS = dict(zip(SANITISE_PARAMS, sanitise.func_defaults))
+
+def get_whitelist_fingerprint(options):
+    """Return a digest of the whitelists and options used by ``sanitise``."""
+
+    spec = []; out = spec.append
+    for param in SANITISE_PARAMS:
+        value = options.get(param, SANITISE_DEFAULTS[param])
+        if isinstance(value, (set, frozenset, list, tuple)):
+            value = sorted(value)
+        out('%s=%r' % (param, value))
+
+    return sha1('\n'.join(spec)).hexdigest()
+
+class SanitiseCache(object):
+    """
+    A callable which caches the output of ``sanitise`` for the given options.
+
+    Entries are kept in a bounded in-process ``local`` cache and, optionally,
+    in a shared ``backend`` -- any client with memcache-style ``get(key)`` and
+    ``set(key, value)`` methods, e.g. App Engine's memcache or a Redis client.
+
+    Keys are made up of a digest of the input HTML and a fingerprint of the
+    whitelists, so changing a whitelist automatically invalidates any existing
+    entries.
+
+    """
+
+    def __init__(
+        self, cache_size=1000, backend=None, key_prefix='sanitise:', **options
+        ):
+        for param in options:
+            if param not in SANITISE_DEFAULTS:
+                raise TypeError("Unknown sanitise option: %r" % param)
+        self.options = options
+        self.fingerprint = get_whitelist_fingerprint(options)
+        self.local = CachingDict(cache_size)
+        self.backend = backend
+        self.key_prefix = key_prefix
+
+    def get_key(self, html):
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        return '%s%s:%s' % (
+            self.key_prefix, self.fingerprint, sha1(html).hexdigest()
+            )
+
+    def __call__(self, html):
+        key = self.get_key(html)
+        local = self.local
+        if key in local:
+            return local[key]
+        backend = self.backend
+        if backend is not None:
+            output = backend.get(key)
+            if output is not None:
+                local[key] = output
+                return output
+        output = local[key] = sanitise(html, **self.options)
+        if backend is not None:
+            backend.set(key, output)
+        return output
+
+# ------------------------------------------------------------------------------
+# Batch Sanitisation
+# ------------------------------------------------------------------------------
+
+WORKER_OPTIONS = {}
+
+def init_worker(options):
+    WORKER_OPTIONS.update(options)
+
+def sanitise_chunk(chunk, options=WORKER_OPTIONS):
+    return [sanitise(html, **options) for html in chunk]
+
+def imap_bounded(pool, chunks, max_pending):
+    """Yield the results of ``chunks`` from the ``pool`` with bounded buffering."""
+
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(sanitise_chunk, (chunk,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def sanitise_many(
+    iterable, workers=None, chunk_size=100, max_pending=None, progress=None,
+    **options
+    ):
+    """
+    Yield sanitised versions of the HTML documents from ``iterable`` in order.
+
+    The documents are sent to a pool of ``workers`` processes in chunks of
+    ``chunk_size``, and at most ``max_pending`` chunks (twice the number of
+    workers by default) are in flight at any time -- so memory use stays
+    bounded however large the input is.
+
+    If ``progress`` is given, it is called with the number of documents done so
+    far and the throughput in documents per second after every chunk.
+
+    """
+
+    iterable = iter(iterable)
+    chunks = iter(lambda: list(islice(iterable, chunk_size)), [])
+
+    if workers == 1:
+        pool = None
+        batches = (sanitise_chunk(chunk, options) for chunk in chunks)
+    else:
+        from multiprocessing import Pool, cpu_count
+        workers = workers or cpu_count()
+        pool = Pool(workers, init_worker, (options,))
+        batches = imap_bounded(pool, chunks, max_pending or (2 * workers))
+
+    count = 0
+    start = time()
+
+    try:
+        for results in batches:
+            for output in results:
+                yield output
+            count += len(results)
+            if progress:
+                progress(count, count / max(time() - start, 1e-6))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+
+# Inline styles typical of content pasted from Word, Google Docs and Gmail.
+BENCHMARK_STYLES = [
+    'margin-bottom: 0.0001pt; line-height: normal',
+    "font-size: 11pt; font-family: 'Calibri', 'sans-serif'; color: #1f497d",
+    'font-size:10.0pt;font-family:"Times New Roman","serif"',
+    'margin: 0in 0in 10pt; text-align: justify',
+    'color: rgb(34, 34, 34); font-family: arial, sans-serif; font-size: 13px',
+    'background-color: transparent; font-weight: 700; vertical-align: baseline',
+    'border-collapse: collapse; width: 100%',
+    'font-size: 15px; font-family: Arial; color: #000000; font-style: italic',
+    'position: absolute; left: -9999px; background: url(javascript:x)',
+    ]
+
+def get_benchmark_document(seed, paragraphs=20, styles=BENCHMARK_STYLES):
+    """Return a document of styled paragraphs like those in pasted content."""
+
+    output = []; out = output.append
+    for idx in xrange(paragraphs):
+        style = styles[(seed + idx) % len(styles)]
+        inner = styles[(seed * 7 + idx) % len(styles)]
+        out('<p class="MsoNormal" style="%s"><span style="%s">Paragraph %d of '
+            'document %d &amp; some <b>bold</b> text.</span></p>' % (
+            style, inner, idx, seed
+            ))
+
+    return '\n'.join(output)
+
+find_style_attrs = re.compile(r'style="([^"]*)"').findall
+
+def benchmark(paths=(), count=1000, workers=None):
+    """
+    Time style handling, ``SanitiseCache`` and ``sanitise_many`` on a corpus.
+
+    The corpus is made up of the HTML files at ``paths`` or, failing those, of
+    ``count`` generated documents with typical pasted inline styles.
+
+    """
+
+    if paths:
+        documents = [open(path, 'rb').read() for path in paths]
+    else:
+        documents = [get_benchmark_document(idx) for idx in xrange(count)]
+
+    styles = []
+    for document in documents:
+        styles.extend(find_style_attrs(document))
+
+    results = {'documents': len(documents), 'styles': len(styles)}
+
+    start = time()
+    for style in styles:
+        sanitise_style(style, cache={})
+    results['style_uncached'] = time() - start
+
+    cache = CachingDict(1000)
+    start = time()
+    for style in styles:
+        sanitise_style(style, cache=cache)
+    results['style_cached'] = time() - start
+
+    start = time()
+    expected = [sanitise(document) for document in documents]
+    results['sanitise'] = time() - start
+
+    cached_sanitise = SanitiseCache(cache_size=len(documents))
+    start = time()
+    for document in documents:
+        cached_sanitise(document)
+    results['cache_cold'] = time() - start
+
+    start = time()
+    for document in documents:
+        cached_sanitise(document)
+    results['cache_warm'] = time() - start
+
+    start = time()
+    output = list(sanitise_many(documents, workers=workers))
+    results['sanitise_many'] = time() - start
+    results['identical'] = output == expected
+
+    return results
 
 # ------------------------------------------------------------------------------
 # Run Tests
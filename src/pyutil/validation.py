@@ -3,6 +3,7 @@
 
 """Service input validation support."""
 
+from math import isinf, isnan
 from time import time
 from sha import new as sha1
 
@@ -13,6 +14,82 @@ from sha import new as sha1
 CO_VARARGS = 4
 CO_VARKEYWORDS = 8
 
+LITERAL_TYPES = (int, long, float)
+
+# ------------------------------------------------------------------------------
+# declarative spec
+# ------------------------------------------------------------------------------
+
+class Check(object):
+    """
+    A declarative spec which gets compiled into inline checks.
+
+      >>> @validate(ratio=Check(float, min=0.0, max=float('inf')))
+      ... def scale(ratio):
+      ...     return ratio * 2
+
+      >>> scale(1.5)
+      3.0
+
+      >>> scale(-1.0)
+      Traceback (most recent call last):
+      ...
+      ValueError: Could not validate input argument 'ratio=-1.0'
+
+    """
+
+    __slots__ = ('type', 'min', 'max')
+
+    def __init__(self, type=None, min=None, max=None):
+        self.type = type
+        self.min = min
+        self.max = max
+
+# ------------------------------------------------------------------------------
+# kode generation
+# ------------------------------------------------------------------------------
+
+def compile_check(validator, name, source, target, rkey, env, error, indent=4):
+    """Return the lines of source code which enforce the given ``validator``."""
+
+    def constant(prefix, value):
+        # Only finite numbers have a repr which can be used as a literal.
+        kind = type(value)
+        if kind in LITERAL_TYPES:
+            if kind is not float or not (isinf(value) or isnan(value)):
+                return repr(value)
+        const = '%s_%s_%s' % (prefix, name, rkey)
+        env[const] = value
+        return const
+
+    pad = ' ' * indent
+    error = '\n'.join(pad + '    ' + line for line in error.splitlines())
+
+    if isinstance(validator, Check):
+        conditions = []
+        if validator.type is not None:
+            conditions.append("isinstance(%s, %s)" % (
+                source, constant('type', validator.type)
+                ))
+        if validator.min is not None:
+            conditions.append("%s >= %s" % (
+                source, constant('min', validator.min)
+                ))
+        if validator.max is not None:
+            conditions.append("%s <= %s" % (
+                source, constant('max', validator.max)
+                ))
+        if not conditions:
+            return []
+        return ["%sif not (%s):" % (pad, ' and '.join(conditions)), error]
+
+    return [
+        "%stry:" % pad,
+        "%s    %s = %s(%s)" % (pad, target, constant('spec', validator), source),
+        "%sexcept Exception:" % pad,
+        error
+        ]
+
 # ------------------------------------------------------------------------------
 # kore validate funktion
 # ------------------------------------------------------------------------------
@@ -23,68 +100,149 @@ def validate(**spec):
     def __decorate(func):
 
         rkey = sha1(str(time())).hexdigest()[:7]
-        rkw = 'kw_%s' % rkey
 
         code = func.func_code
-        varnames = list(code.co_varnames)
+        varnames = list(code.co_varnames[:code.co_argcount])
         defaults = func.func_defaults or ()
         func_name = func.func_name
 
         varargs = varkwargs = None
-
-        if code.co_flags & CO_VARKEYWORDS:
-            varkwargs = varnames.pop(-1)
+        extra = code.co_argcount
 
         if code.co_flags & CO_VARARGS:
-            varargs = varnames.pop(-1)
+            varargs = code.co_varnames[extra]
+            extra += 1
 
-        params = [varnames.pop(0)]; add = params.append
-        params2 = params[:]; add2 = params2.append
+        if code.co_flags & CO_VARKEYWORDS:
+            varkwargs = code.co_varnames[extra]
+
+        params = []; add = params.append
+        params2 = []; add2 = params2.append
         default_pointer = len(varnames) - len(defaults)
 
         for idx, varname in enumerate(varnames):
             if idx < default_pointer:
                 add(varname)
-                add2("%s[%r]" % (rkw, varname))
             else:
                 add("%s=defaults_%s[%s]" % (varname, rkey, idx-default_pointer))
-                add2("%s=%s.get(%r, defaults_%s[%s])" % (varname, rkw, varname, rkey, idx-default_pointer))
+            add2(varname)
 
         if varargs:
             add("*%s" % varargs)
-            add2("*%s[%r]" % (rkw, varargs))
+            add2("*%s" % varargs)
         if varkwargs:
             add("**%s" % varkwargs)
-            add2("**%s[%r]" % (rkw, varkwargs))
-            
-        params = ", ".join(params)
-        params2 = ", ".join(params2)
-
-        source = """
-def %(func_name)s(%(params)s):
-    kws_%(r)s = locals()
-    kw_%(r)s = {}
-    for key_%(r)s in kws_%(r)s:
-        if key_%(r)s in spec_%(r)s: 
-            try:
-                kw_%(r)s[key_%(r)s] = spec_%(r)s[key_%(r)s](kws_%(r)s[key_%(r)s])
-            except Exception:
-                raise ValueError(
-                    "Could not validate input argument '%%s=%%s'" %% (key_%(r)s, kws_%(r)s[key_%(r)s])
-                    )
-        else:
-            kw_%(r)s[key_%(r)s] = kws_%(r)s[key_%(r)s]
-    return func_%(r)s(%(params2)s)
-""" % dict(params=params, params2=params2, r=rkey, func_name=func_name)
+            add2("**%s" % varkwargs)
 
         env = {
             'func_%s' % rkey: func,
-            'spec_%s' % rkey: spec,
             'defaults_%s' % rkey: defaults,
             'ValueError': ValueError
             }
+
+        # Generate straight-line code for just the arguments in the spec.
+        checks = []
+
+        for varname in varnames + [varargs, varkwargs]:
+            if not varname or varname not in spec:
+                continue
+            checks.extend(compile_check(
+                spec[varname], varname, varname, varname, rkey, env, (
+                "raise ValueError(\n"
+                "    \"Could not validate input argument '%%s=%%s'\" %% "
+                "(%r, %s)\n"
+                "    )" % (varname, varname)
+                )))
+
+        source = """
+def %(func_name)s(%(params)s):
+%(checks)s
+    return func_%(r)s(%(params2)s)
+""" % dict(
+            params=", ".join(params), params2=", ".join(params2), r=rkey,
+            func_name=func_name, checks='\n'.join(checks)
+            )
+
         exec source in env
 
         return env[func_name]
 
     return __decorate
+
+# ------------------------------------------------------------------------------
+# bulk validation of records
+# ------------------------------------------------------------------------------
+
+class Schema(object):
+    """Validate dict records against a ``spec`` of field validators."""
+
+    def __init__(self, optional=(), **spec):
+        self.spec = spec
+        self.optional = frozenset(optional)
+        self.validate = self.compile()
+
+    def compile(self):
+        rkey = sha1(str(time())).hexdigest()[:7]
+        env = {}
+        lines = [
+            "def validate(record):",
+            "    try:",
+            "        result = dict(record)",
+            "    except (TypeError, ValueError):",
+            "        return None, {None: 'Could not validate input record'}",
+            "    errors = {}"
+            ]
+        out = lines.append
+        for idx, field in enumerate(sorted(self.spec)):
+            out("    if %r in result:" % field)
+            out("        value = result[%r]" % field)
+            lines.extend(compile_check(
+                self.spec[field], 'field%d' % idx, 'value',
+                'result[%r]' % field, rkey, env,
+                "errors[%r] = \"Could not validate input field '%%s=%%s'\" %% "
+                "(%r, value)" % (field, field), indent=8
+                ))
+            if field not in self.optional:
+                out("    else:")
+                out("        errors[%r] = 'Missing required field'" % field)
+        out("    return result, errors")
+        exec '\n'.join(lines) in env
+        return env['validate']
+
+    def validate_many(self, records):
+        """
+        Return a ``(results, errors)`` tuple for the given records.
+
+        The ``results`` list has the validated version of each record, or
+        ``None`` if it failed validation, and ``errors`` maps the index of each
+        failed record to a dict of its field errors. The error for a record
+        which isn't a mapping at all is keyed by ``None``:
+
+          >>> schema = Schema(a=Check(int))
+          >>> schema.validate_many([{'a': 1}, None, {'a': '2'}])
+          ([{'a': 1}, None, None], {1: {None: 'Could not validate input record'}, 2: {'a': "Could not validate input field 'a=2'"}})
+
+        """
+
+        validate = self.validate
+        results = []; append = results.append
+        errors = {}
+
+        for idx, record in enumerate(records):
+            result, record_errors = validate(record)
+            if record_errors:
+                errors[idx] = record_errors
+                append(None)
+            else:
+                append(result)
+
+        return results, errors
+
+# ------------------------------------------------------------------------------
+# run tests
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    import doctest
+    doctest.testmod()
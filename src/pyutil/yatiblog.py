@@ -16,15 +16,22 @@ import sys
 
 from cStringIO import StringIO
 from datetime import datetime
-from os import chdir, getcwd, environ, listdir, mkdir, remove as rm, stat, walk
+from hashlib import sha1
+from os import chdir, execv, getcwd, getpid, listdir, makedirs, mkdir, rename
+from os import remove as rm, stat, walk
 from os.path import (
     abspath, basename, dirname, exists, join as join_path, isfile, isdir,
     realpath, splitext
     )
 
+from multiprocessing import Pool, cpu_count
 from optparse import OptionParser
-from pickle import load as load_pickle, dump as dump_pickle
+from pickle import dump as dump_pickle, dumps as dumps_pickle
+from pickle import load as load_pickle
 from re import compile
+from shutil import rmtree
+from time import sleep, time
+from traceback import print_exc
 from tokenize import generate_tokens, COMMENT, STRING, INDENT, NEWLINE, NL
 
 from genshi.template import MarkupTemplate, NewTextTemplate as TextTemplate
@@ -32,8 +39,8 @@ from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from yaml import safe_load as load_yaml
 
-from pyutil.env import run_command
-from pyutil.rst import render_rst, SYNTAX_FORMATTER
+from pyutil.env import CommandNotFound, run_command
+from pyutil.rst import Renderer, SYNTAX_FORMATTER
 from pyutil.scm import SCMConfig
 
 # ------------------------------------------------------------------------------
@@ -139,31 +146,87 @@ def replace_python_docstrings(source, non_code=(COMMENT, NEWLINE, NL)):
     out('\n'.join(source_lines[prev_row:]))
     return ''.join(result)
 
-def get_git_info(filename):
-    """Extract info from the Git repository."""
+def load_git_history(directory, cache_path=None):
+    """
+    Return the Git root for ``directory`` and the last commit of each file.
+
+    The commit info for every tracked file is gathered in a single ``git log``
+    pass, and is cached at ``cache_path`` against the current HEAD commit so
+    that it only needs to be regenerated after a new commit.
 
-    environ['TZ'] = 'UTC'
-    git_info = run_command(['git', 'log', '--pretty=raw', '--', filename])
+    """
+
+    try:
+        root, retcode = run_command(
+            ['git', 'rev-parse', '--show-toplevel'], retcode=True, cwd=directory
+            )
+    except CommandNotFound:
+        return None, {}
+
+    root = root.strip()
+    if retcode or not root:
+        return None, {}
+
+    root = realpath(root)
+    head = run_command(['git', 'rev-parse', '--verify', '-q', 'HEAD'], cwd=root)
+    head = head.strip()
+    if not head:
+        return root, {}
+
+    if cache_path and isfile(cache_path):
+        cache_file = open(cache_path, 'rb')
+        cached = load_pickle(cache_file)
+        cache_file.close()
+        if cached['root'] == root and cached['head'] == head:
+            return root, cached['history']
+
+    log = run_command([
+        'git', 'log', '-z', '--name-only', '--pretty=format:%x01%ae %at', head
+        ], cwd=root, universal_newlines=False)
+
+    history = {}
+    for commit in log.split('\x01'):
+        header, _, files = commit.partition('\n')
+        if not files:
+            continue
+        email, timestamp = header.rsplit(' ', 1)
+        if '(' in email:
+            email = email.split('(')[0].strip()
+        for path in files.split('\0'):
+            if path and path not in history:
+                history[path] = (email, timestamp)
+
+    if cache_path:
+        cache_directory = dirname(cache_path)
+        if not isdir(cache_directory):
+            makedirs(cache_directory)
+        write_file_atomically(cache_path, dumps_pickle({
+            'head': head, 'history': history, 'root': root
+            }, 2))
+
+    return root, history
+
+def get_git_info(filename, root=None, history=None):
+    """Extract info from the Git history loaded by ``load_git_history``."""
 
     info = {'__git__': False}
+    commit = None
+
+    if root:
+        path = realpath(filename)
+        if path.startswith(root + '/'):
+            commit = history.get(path[len(root)+1:])
 
-    if (not git_info) or git_info.startswith('fatal:'):
+    if commit is None:
         info['__updated__'] = datetime.utcfromtimestamp(
             stat(filename).st_mtime
             )
         return info
 
+    email, timestamp = commit
     info['__git__'] = True
-
-    for line in git_info.splitlines():
-        if line.startswith('author'):
-            email, timestamp, tz = line.split()[-3:]
-            email = email.lstrip('<').rstrip('>')
-            if '(' in email:
-                email = email.split('(')[0].strip()
-            info['__by__'] = email
-            info['__updated__'] = datetime.utcfromtimestamp(float(timestamp))
-            break
+    info['__by__'] = email
+    info['__updated__'] = datetime.utcfromtimestamp(float(timestamp))
 
     return info
 
@@ -214,13 +277,21 @@ def load_layout(name, path, layouts, deps=None):
 
     layouts[name] = {
         '__deps__': deps,
+        '__digest__': sha1(content).hexdigest(),
         '__env__': env,
-        '__mtime__': stat(template_path).st_mtime,
         '__name__': name,
         '__path__': template_path,
         '__template__': template,
         }
 
+def get_layout_chain(layout, layouts):
+    """Return the given layout followed by the layouts it extends."""
+
+    deps = layouts[layout]['__deps__']
+    if deps:
+        return [layout] + deps
+    return [layout]
+
 # Define the mappings for the supported programming languages.
 PROGLANGS = {
     '.coffee': ['coffeescript', '#', None],
@@ -245,6 +316,311 @@ for lang_settings in PROGLANGS.values():
 
 del comment_symbol, lang_settings
 
+# ------------------------------------------------------------------------------
+# Build Cache
+# ------------------------------------------------------------------------------
+
+def canonicalise(value):
+    """Return a version of ``value`` with a deterministic repr."""
+
+    if isinstance(value, dict):
+        return sorted(
+            (key, canonicalise(item)) for key, item in value.iteritems()
+            )
+    if isinstance(value, (list, tuple)):
+        return [canonicalise(item) for item in value]
+    return value
+
+def get_digest(*values):
+    """Return the hex digest for the given ``values``."""
+    return sha1(repr(canonicalise(values))).hexdigest()
+
+def read_file(path):
+    file_obj = open(path, 'rb')
+    content = file_obj.read()
+    file_obj.close()
+    return content
+
+def write_file_atomically(path, content):
+    tmp_path = '%s.%s.tmp' % (path, getpid())
+    file_obj = open(tmp_path, 'wb')
+    file_obj.write(content)
+    file_obj.close()
+    rename(tmp_path, path)
+
+class BuildCache(object):
+    """
+    A persistent build cache keyed by content hashes.
+
+    The ``manifest`` maps each generated file to the digest of all the inputs
+    it was built from -- its source, layout chain, includes and config -- so
+    that files are only regenerated when their content would change. Rendered
+    reST fragments are stored separately under their own content digests so
+    that unchanged inputs never have to be re-rendered. The manifest also keeps
+    track of the fragments used by each file, so that any which are no longer
+    used can be removed when the cache is saved.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fragment_directory = join_path(directory, 'fragments')
+        self.manifest_path = join_path(directory, 'manifest')
+        self.renderer = Renderer()
+        self.changed = False
+        if isfile(self.manifest_path):
+            manifest_file = open(self.manifest_path, 'rb')
+            self.manifest = load_pickle(manifest_file)
+            manifest_file.close()
+        else:
+            self.manifest = {}
+
+    def is_fresh(self, genfile, key):
+        entry = self.manifest.get(genfile)
+        return entry is not None and entry[0] == key and isfile(genfile)
+
+    def update(self, genfile, key, fragments=()):
+        self.manifest[genfile] = (key, tuple(fragments))
+        self.changed = True
+
+    def retain(self, genfiles):
+        """Forget the entries for any files other than the given ``genfiles``."""
+        genfiles = set(genfiles)
+        for genfile in self.manifest.keys():
+            if genfile not in genfiles:
+                del self.manifest[genfile]
+                self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        if not isdir(self.directory):
+            mkdir(self.directory)
+        write_file_atomically(self.manifest_path, dumps_pickle(self.manifest))
+        self.changed = False
+        if not isdir(self.fragment_directory):
+            return
+        used = set()
+        for _, fragments in self.manifest.itervalues():
+            used.update(fragments)
+        for filename in listdir(self.fragment_directory):
+            if filename not in used:
+                rm(join_path(self.fragment_directory, filename))
+
+    def render_rst(
+        self, source, deps_digest='', lead=None, fragments=None, **kwargs
+        ):
+        key = get_digest(source, lead, deps_digest, kwargs)
+        if fragments is not None:
+            fragments.append(key)
+        path = join_path(self.fragment_directory, key)
+        if isfile(path):
+            fragment_file = open(path, 'rb')
+            fragment = load_pickle(fragment_file)
+            fragment_file.close()
+            return fragment
+        if lead is None:
+            fragment = self.renderer.render(source, **kwargs)
+        else:
+            fragment = self.renderer.render_with_lead(source, lead, **kwargs)
+        if not isdir(self.fragment_directory):
+            try:
+                makedirs(self.fragment_directory)
+            except OSError:
+                # Another worker process may have just created it.
+                if not isdir(self.fragment_directory):
+                    raise
+        write_file_atomically(path, dumps_pickle(fragment, 2))
+        return fragment
+
+# ------------------------------------------------------------------------------
+# Source Rendering
+# ------------------------------------------------------------------------------
+
+# The state for the current build is kept at the module level so that it is
+# inherited by forked worker processes instead of having to be pickled.
+BUILD = {}
+
+def render_source(source):
+    """Render the given source, write it out and return its info dict."""
+
+    cache = BUILD['cache']
+    config = BUILD['config']
+    data_dict = BUILD['data_dict']
+    layouts = BUILD['layouts']
+    verbose = BUILD['verbose']
+
+    info = config.copy()
+    info.update(BUILD['sources'][source])
+    fragments = info['__fragments__'] = []
+
+    if verbose:
+        print
+        print LINE
+        print 'Converting: [%s] %s' % (info['__type__'], info['__path__'])
+        print LINE
+        print
+
+    if info['__type__'] == 'code':
+
+        content = info['__content__']
+        conf = PROGLANGS[info['__filetype__']]
+        if conf[2]:
+            content = conf[2](content)
+        comment_matcher = conf[3]
+
+        lines = content.split('\n')
+        include_section = None
+
+        if lines and lines[0].startswith('#!'):
+            lines.pop(0)
+
+        sections = []; new_section = sections.append
+        docs_text = []; docs_out = docs_text.append
+        code_text = []; code_out = code_text.append
+
+        for line in lines:
+            if comment_matcher.match(line):
+                line = comment_matcher.sub('', line)
+                if line == '<yatiblog.comment>':
+                    include_section = 1
+                else:
+                    docs_out(line)
+            else:
+                if not line.strip():
+                    if docs_text and not include_section:
+                        last_line = docs_text[-1].strip()
+                        if last_line:
+                            last_line_char = last_line[0]
+                            for char in last_line:
+                                if char != last_line_char:
+                                    break
+                            else:
+                                include_section = 1
+                else:
+                    if docs_text:
+                        include_section = 1
+                if docs_text:
+                    if include_section:
+                        new_section({
+                            'docs_text': '\n'.join(docs_text) + '\n',
+                            'code_text': '\n'.join(code_text)
+                            })
+                        docs_text[:] = []
+                        code_text[:] = []
+                        include_section = None
+                    else:
+                        docs_text[:] = []
+                    code_out(line)
+                else:
+                    code_out(line)
+
+        new_section({'docs_text': '', 'code_text': '\n'.join(code_text)})
+
+        docs = conf[6].join(part['docs_text'] for part in sections)
+        code = conf[4].join(part['code_text'] for part in sections)
+
+        docs_html, props = cache.render_rst(
+            docs, fragments=fragments, with_props=1
+            )
+        if ('title' in props) and props['title']:
+            info['title'] = props['title']
+
+        code = code.replace('\t', '    ')
+        code_html = highlight(code, get_lexer_by_name(conf[0]), SYNTAX_FORMATTER)
+
+        docs_split = conf[7].split(docs_html)
+        code_split = conf[5].split(code_html)
+        output = info['__output__'] = []
+        out = output.append
+
+        if docs_split and docs_split[0]:
+            diff = 0
+            docs_split.insert(0, u'')
+        else:
+            diff = 1
+
+        last = len(docs_split) - 2
+        for i in range(last + 1):
+            code = code_split[i+diff].split(u'<br/>')
+            while (code and code[0] == ''):
+                code.pop(0)
+            while (code and code[-1] == ''):
+                code.pop()
+            code = u'<br />'.join(code)
+            if code:
+                if i == last:
+                    code = u'<div class="syntax"><pre>' + code
+                else:
+                    code = u'<div class="syntax"><pre>' + code + "</pre></div>"
+            out((docs_split[i], code))
+
+    elif info['__rst__']:
+        kwargs = {}
+        with_props = info.get('with_props', False)
+        if with_props:
+            kwargs['with_props'] = 1
+
+        # The lead is cut out of the full render where possible instead of
+        # being rendered separately.
+        if info['__lead__'] == info['__content__']:
+            output = cache.render_rst(
+                info['__content__'], info['__deps_digest__'],
+                fragments=fragments, **kwargs
+                )
+            lead_output = None
+        else:
+            output, lead_output = cache.render_rst(
+                info['__content__'], info['__deps_digest__'], info['__lead__'],
+                fragments, **kwargs
+                )
+
+        if with_props:
+            output, props = output
+            if ('title' in props) and props['title']:
+                info['title'] = props['title']
+
+        if lead_output is None:
+            lead_output = output
+
+        info['__output__'] = output
+        info['__lead_output__'] = lead_output
+    else:
+        output = ''
+
+    for layout in get_layout_chain(info['__layout__'], layouts):
+        template = layouts[layout]['__template__']
+        output = template.generate(
+            content=output,
+            yatidb=data_dict,
+            **info
+            ).render('xhtml', encoding=None)
+
+    if isinstance(output, unicode):
+        output = output.encode('utf-8')
+
+    output_file = open(info['__genfile__'], 'wb')
+    output_file.write(output)
+    output_file.close()
+
+    if verbose:
+        print 'Done!'
+
+    return info
+
+def render_sources(sources, jobs=1):
+    """Render the given sources, using a pool of ``jobs`` worker processes."""
+
+    if jobs == 1 or len(sources) < 2:
+        return map(render_source, sources)
+
+    pool = Pool(jobs)
+    try:
+        return pool.map(render_source, sources, 1)
+    finally:
+        pool.close()
+        pool.join()
+
 # ------------------------------------------------------------------------------
 # Our Main Script Function
 # ------------------------------------------------------------------------------
@@ -256,6 +632,9 @@ def main(argv=None):
         usage="Usage: %prog [options] [path/to/source/directory]"
         )
 
+    op.add_option('-c', dest='cache_directory', default='.buildcache',
+                  help="Set the build cache directory (default: .buildcache)")
+
     op.add_option('-d', dest='data_file', default='.articlestore',
                   help="Set the path for a data file (default: .articlestore)")
 
@@ -265,6 +644,9 @@ def main(argv=None):
     op.add_option('-p', dest='package', default='',
                   help="Generate documentation for a Python package (optional)")
 
+    op.add_option('-j', dest='jobs', default=0, type='int',
+                  help="Set the number of render processes (default: CPUs)")
+
     op.add_option('--clean', dest='clean', default=False, action='store_true',
                   help="Flag to remove all generated output files")
 
@@ -274,11 +656,19 @@ def main(argv=None):
     op.add_option('--quiet', dest='quiet', default=False, action='store_true',
                   help="Flag to suppress output")
 
+    op.add_option('--watch', dest='watch', default=False, action='store_true',
+                  help="Flag to keep rebuilding outputs as their inputs change")
+
+    op.add_option('--interval', dest='interval', default=0.25, type='float',
+                  help="Set the --watch polling interval (default: 0.25)")
+
     try:
         options, args = op.parse_args(argv)
     except SystemExit:
         return
 
+    initial_directory = getcwd()
+
     # Normalise various options and load from the config file.
     if args:
         source_directory = args[0]
@@ -369,12 +759,15 @@ def main(argv=None):
     else:
         data_dict = {}
 
-    # Persist the data file to disk.
+    cache = BuildCache(join_path(source_directory, options.cache_directory))
+
+    # Persist the data file and build cache to disk if anything was rebuilt.
     def persist_data_file():
-        if data_file:
+        if data_file and cache.changed:
             data_file_obj = open(data_file, 'wb')
             dump_pickle(data_dict, data_file_obj)
             data_file_obj.close()
+        cache.save()
 
     atexit.register(persist_data_file)
 
@@ -397,6 +790,10 @@ def main(argv=None):
                 if verbose:
                     print "Removing: %s" % file
                 rm(file)
+        if isdir(cache.directory):
+            if verbose:
+                print "Removing: %s" % cache.directory
+            rmtree(cache.directory)
         data_dict.clear()
         sys.exit()
 
@@ -444,7 +841,6 @@ def main(argv=None):
             '__id__': source_file,
             '__layout__': layout,
             '__lead__': lead,
-            '__mtime__': stat(source_path).st_mtime,
             '__name__': basename(destname), # filebase,
             '__outdir__': output_directory,
             '__path__': source_path,
@@ -474,7 +870,6 @@ def main(argv=None):
             '__id__': source_path,
             '__layout__': code_layout,
             '__lead__': '',
-            '__mtime__': stat(source_path).st_mtime,
             '__name__': basename(destname), # filebase,
             '__outdir__': output_directory,
             '__path__': source_path,
@@ -490,36 +885,45 @@ def main(argv=None):
         init_rst_source_code(source_path, destname)
 
     # And likewise for the ``index_pages``.
-    render_last = set()
+    def init_index_source(index_page, index_source):
 
-    for index_page, index_source in index_pages.items():
         layout, filetype = splitext(index_source)
-        if filetype == '.genshi':
-            if layout not in layouts:
-                load_layout(layout, source_directory, layouts)
-            source_path = join_path(source_directory, '_layouts', index_source)
-            sources[index_source] = {
-                '__content__': '',
-                '__deps__': [],
-                '__env__': {},
-                '__genfile__': join_path(output_directory, index_page),
-                '__id__': index_source,
-                '__layout__': layout,
-                '__lead__': '',
-                '__mtime__': stat(source_path).st_mtime,
-                '__name__': basename(index_page),
-                '__outdir__': output_directory,
-                '__path__': source_path,
-                '__rst__': False,
-                '__type__': 'index',
-                '__filetype__': 'genshi'
-                }
-        else:
+        if filetype != '.genshi':
             init_rst_source(index_source, index_page)
+            return
+
+        if layout not in layouts:
+            load_layout(layout, source_directory, layouts)
+
+        source_path = join_path(source_directory, '_layouts', index_source)
+        sources[index_source] = {
+            '__content__': '',
+            '__deps__': [],
+            '__env__': {},
+            '__genfile__': join_path(output_directory, index_page),
+            '__id__': index_source,
+            '__layout__': layout,
+            '__lead__': '',
+            '__name__': basename(index_page),
+            '__outdir__': output_directory,
+            '__path__': source_path,
+            '__rst__': False,
+            '__type__': 'index',
+            '__filetype__': 'genshi'
+            }
+
+    render_last = set()
+
+    for index_page, index_source in index_pages.items():
+        init_index_source(index_page, index_source)
         render_last.add(index_source)
 
     # Update the envs for all the source files.
-    for source in sources:
+    git_root, git_history = load_git_history(
+        source_directory, join_path(cache.directory, 'git-history')
+        )
+
+    def update_env(source):
         info = sources[source]
         layout = info['__layout__']
         layout_info = layouts[layout]
@@ -527,209 +931,186 @@ def main(argv=None):
             for dep_layout in reversed(layout_info['__deps__']):
                 info.update(layouts[dep_layout]['__env__'])
         info.update(layouts[layout]['__env__'])
-        info.update(get_git_info(info['__path__']))
+        info.update(get_git_info(info['__path__'], git_root, git_history))
         info.update(info.pop('__env__'))
+        info['__deps_digest__'] = get_digest(*[
+            read_file(join_path(source_directory, dep))
+            for dep in info['__deps__']
+            ])
+        info['__build_key__'] = get_digest(config, info, [
+            layouts[name]['__digest__']
+            for name in get_layout_chain(layout, layouts)
+            ])
 
-    # Figure out which files to regenerate.
-    if not options.force:
-
-        no_regen = set()
-        for source in sources:
-
-            info = sources[source]
-            try:
-                gen_mtime = stat(info['__genfile__']).st_mtime
-            except:
-                continue
+    for source in sources:
+        update_env(source)
 
-            dirty = False
-            if gen_mtime < info['__mtime__']:
-                dirty = True
+    cache.retain(info['__genfile__'] for info in sources.itervalues())
 
-            layout = info['__layout__']
-            layout_info = layouts[layout]
-            if layout_info['__deps__']:
-                layout_chain = [layout] + layout_info['__deps__']
-            else:
-                layout_chain = [layout]
+    # Figure out which files to regenerate.
+    pending = set(sources)
 
-            for layout in layout_chain:
-                if gen_mtime < layouts[layout]['__mtime__']:
-                    dirty = True
-                    break
+    if not options.force:
 
-            for dep in info['__deps__']:
-                dep_mtime = stat(join_path(source_directory, dep)).st_mtime
-                if gen_mtime < dep_mtime:
-                    dirty = True
-                    break
+        no_regen = set(
+            source for source, info in sources.iteritems()
+            if cache.is_fresh(info['__genfile__'], info['__build_key__'])
+            )
 
-            if not dirty:
-                no_regen.add(source)
+        pending.difference_update(no_regen.difference(render_last))
+        if pending == render_last:
+            pending.difference_update(no_regen)
 
-        for source in no_regen:
-            if source in render_last:
-                continue
-            del sources[source]
+    # Regenerate! Independent sources are rendered in parallel, and the index
+    # pages are rendered last so that they see the updated data.
+    BUILD.update(
+        cache=cache, config=config, data_dict=data_dict, layouts=layouts,
+        sources=sources, verbose=verbose
+        )
 
-        remaining = set(sources.keys())
-        if remaining == render_last:
-            for source in remaining.intersection(no_regen):
-                del sources[source]
+    jobs = options.jobs or cpu_count()
+    independent = sorted(
+        source for source in pending if source not in render_last
+        )
 
-    # Regenerate!
-    items = sorted(sources.items(), key=lambda x: x[1]['__rst__'] == False)
+    for info in render_sources(independent, jobs):
+        data_dict[info['__name__']] = info
+        cache.update(
+            info['__genfile__'], info['__build_key__'], info['__fragments__']
+            )
 
-    for source, source_info in items:
+    for source in sorted(render_last.intersection(pending)):
+        info = render_source(source)
+        data_dict[info['__name__']] = info
+        cache.update(
+            info['__genfile__'], info['__build_key__'], info['__fragments__']
+            )
 
-        info = config.copy()
-        info.update(source_info)
+    if not options.watch:
+        sys.exit()
 
-        if verbose:
-            print
-            print LINE
-            print 'Converting: [%s] %s' % (info['__type__'], info['__path__'])
-            print LINE
-            print
-
-        if info['__type__'] == 'code':
-
-            content = info['__content__']
-            conf = PROGLANGS[info['__filetype__']]
-            if conf[2]:
-                content = conf[2](content)
-            comment_matcher = conf[3]
-
-            lines = content.split('\n')
-            include_section = None
-
-            if lines and lines[0].startswith('#!'):
-                lines.pop(0)
-
-            sections = []; new_section = sections.append
-            docs_text = []; docs_out = docs_text.append
-            code_text = []; code_out = code_text.append
-
-            for line in lines:
-                if comment_matcher.match(line):
-                    line = comment_matcher.sub('', line)
-                    if line == '<yatiblog.comment>':
-                        include_section = 1
-                    else:
-                        docs_out(line)
-                else:
-                    if not line.strip():
-                        if docs_text and not include_section:
-                            last_line = docs_text[-1].strip()
-                            if last_line:
-                                last_line_char = last_line[0]
-                                for char in last_line:
-                                    if char != last_line_char:
-                                        break
-                                else:
-                                    include_section = 1
-                    else:
-                        if docs_text:
-                            include_section = 1
-                    if docs_text:
-                        if include_section:
-                            new_section({
-                                'docs_text': '\n'.join(docs_text) + '\n',
-                                'code_text': '\n'.join(code_text)
-                                })
-                            docs_text[:] = []
-                            code_text[:] = []
-                            include_section = None
-                        else:
-                            docs_text[:] = []
-                        code_out(line)
-                    else:
-                        code_out(line)
+    # In --watch mode, we keep the parsed sources and layouts in memory, and
+    # use a reverse dependency graph of the input files to only rebuild the
+    # affected outputs whenever an input changes.
+    persist_data_file()
+
+    code_destnames = dict((path, dest) for dest, path in code_files.items())
+    index_destnames = dict((src, page) for page, src in index_pages.items())
+    known_source_files = set(source_files)
+
+    def get_dependents():
+        dependents = {}
+        for source, info in sources.iteritems():
+            paths = [info['__path__']]
+            paths.extend(
+                join_path(source_directory, dep) for dep in info['__deps__']
+                )
+            paths.extend(
+                layouts[name]['__path__']
+                for name in get_layout_chain(info['__layout__'], layouts)
+                )
+            for path in paths:
+                dependents.setdefault(path, set()).add(source)
+        return dependents
+
+    def get_file_stats(paths):
+        file_stats = {}
+        for path in paths:
+            try:
+                file_stat = stat(path)
+            except OSError:
+                file_stats[path] = None
+            else:
+                file_stats[path] = (file_stat.st_mtime, file_stat.st_size)
+        return file_stats
 
-            new_section({'docs_text': '', 'code_text': '\n'.join(code_text)})
+    def rebuild(changed, new_source_files):
 
-            docs = conf[6].join(part['docs_text'] for part in sections)
-            code = conf[4].join(part['code_text'] for part in sections)
+        start = time()
 
-            docs_html, props = render_rst(docs, with_props=1)
-            if ('title' in props) and props['title']:
-                info['title'] = props['title']
+        for name, layout_info in layouts.items():
+            if layout_info['__path__'] in changed:
+                load_layout(name, source_directory, layouts)
 
-            code = code.replace('\t', '    ')
-            code_html = highlight(code, get_lexer_by_name(conf[0]), SYNTAX_FORMATTER)
+        affected = set(new_source_files)
+        for path in changed:
+            affected.update(dependents.get(path, ()))
 
-            docs_split = conf[7].split(docs_html)
-            code_split = conf[5].split(code_html)
-            output = info['__output__'] = []
-            out = output.append
+        for source in affected:
+            sources.pop(source, None)
+            try:
+                if source in index_destnames:
+                    init_index_source(index_destnames[source], source)
+                elif source in code_destnames:
+                    init_rst_source_code(source, code_destnames[source])
+                else:
+                    init_rst_source(source)
+            except IOError:
+                # The source file has been removed.
+                continue
+            if source in sources:
+                update_env(source)
+
+        affected.intersection_update(sources)
+        cache.retain(info['__genfile__'] for info in sources.itervalues())
+        rendered = [
+            render_source(source) for source in sorted(affected)
+            if source not in render_last
+            ]
+
+        if rendered:
+            affected.update(render_last.intersection(sources))
+
+        for source in sorted(render_last.intersection(affected)):
+            rendered.append(render_source(source))
+
+        for info in rendered:
+            data_dict[info['__name__']] = info
+            cache.update(
+                info['__genfile__'], info['__build_key__'],
+                info['__fragments__']
+                )
+
+        persist_data_file()
+        if verbose:
+            print "Rebuilt %d file(s) in %.2fs" % (len(rendered), time() - start)
 
-            if docs_split and docs_split[0]:
-                diff = 0
-                docs_split.insert(0, u'')
-            else:
-                diff = 1
-
-            last = len(docs_split) - 2
-            for i in range(last + 1):
-                code = code_split[i+diff].split(u'<br/>')
-                while (code and code[0] == ''):
-                    code.pop(0)
-                while (code and code[-1] == ''):
-                    code.pop()
-                code = u'<br />'.join(code)
-                if code:
-                    if i == last:
-                        code = u'<div class="syntax"><pre>' + code
-                    else:
-                        code = u'<div class="syntax"><pre>' + code + "</pre></div>"
-                out((docs_split[i], code))
-
-        elif info['__rst__']:
-            with_props = info.get('with_props', False)
-            if with_props:
-                output, props = render_rst(info['__content__'], with_props=1)
-                if ('title' in props) and props['title']:
-                    info['title'] = props['title']
-                info['__output__'] = output
-            else:
-                output = info['__output__'] = render_rst(info['__content__'])
+    dependents = get_dependents()
+    watched = get_file_stats(list(dependents) + [config_file])
 
-            if info['__lead__'] == info['__content__']:
-                info['__lead_output__'] = info['__output__']
-            else:
-                info['__lead_output__'] = render_rst(info['__lead__'])
-        else:
-            output = ''
+    if verbose:
+        print "Watching %d files for changes ..." % len(watched)
 
-        layout = info['__layout__']
-        layout_info = layouts[layout]
+    while 1:
 
-        if layout_info['__deps__']:
-            layout_chain = [layout] + layout_info['__deps__']
-        else:
-            layout_chain = [layout]
+        sleep(options.interval)
 
-        for layout in layout_chain:
-            template = layouts[layout]['__template__']
-            output = template.generate(
-                content=output,
-                yatidb=data_dict,
-                **info
-                ).render('xhtml', encoding=None)
+        current = get_file_stats(watched)
+        changed = set(
+            path for path in current if current[path] != watched[path]
+            )
+        new_source_files = [
+            file for file in listfiles(source_directory)
+            if file.endswith('.txt') and file not in known_source_files
+            ]
 
-        if isinstance(output, unicode):
-            output = output.encode('utf-8')
+        if not (changed or new_source_files):
+            continue
 
-        data_dict[info['__name__']] = info
+        if config_file in changed:
+            print "Restarting as %s has changed ..." % config_file
+            chdir(initial_directory)
+            execv(sys.executable, [sys.executable] + sys.argv)
 
-        output_file = open(info['__genfile__'], 'wb')
-        output_file.write(output)
-        output_file.close()
+        known_source_files.update(new_source_files)
 
-        if verbose:
-            print 'Done!'
+        try:
+            rebuild(changed, new_source_files)
+        except Exception:
+            print_exc()
 
-    sys.exit()
+        dependents = get_dependents()
+        watched = get_file_stats(list(dependents) + [config_file])
 
 # PDF_COMMAND = ['prince', '--input=html', '--output=pdf'] # --no-compress
 # PDF_CSS = join_path(WEBSITE_ROOT, 'static', 'css', 'print.css')